@@ -25,7 +25,12 @@ __version__ = '$Id: common.py,v de859cceb463 2010/10/28 09:10:17 dinko $'
 
 
 import os
+import re
+import time
+import errno
 import fcntl
+import select
+import bisect
 import cPickle
 import hashlib
 import signal
@@ -37,19 +42,255 @@ import getopt
 import atexit
 
 
-def sha1sum(path):
+# default limit of captured stdout and stderr of every child process
+OUTPUT_LIMIT = 65536
+
+# status files kept in memory when all stages run in one process, in
+# checkpoint order, and their objects {path: object}; see share_atomic()
+SharedPaths = []
+SharedObjects = {}
+SharedDirty = set()
+
+
+def sha1sum(path, blocksize=None):
     """Calculate SHA1 sum of given file. Returns SHA1 hex digest as
-    string.
+    string or, if blocksize is given, a tuple of hex digest and list of
+    hex digests of every block.
     """
     sha1 = hashlib.sha1()
+    blocks = []
     sha1file = open(path, 'rb')
-    # read chunks of 128k
-    for chunk in iter(lambda: sha1file.read(131072), ''):
+    # read chunks of 128k or whole blocks
+    for chunk in iter(lambda: sha1file.read(blocksize or 131072), ''):
         sha1.update(chunk)
+        if blocksize:
+            blocks.append(hashlib.sha1(chunk).hexdigest())
     sha1file.close()
+    if blocksize:
+        return sha1.hexdigest(), blocks
     return sha1.hexdigest()
 
+def blocks_path(blocksdir, path):
+    """Returns path of block digests file for a given file.
+    """
+    return os.path.join(blocksdir, hashlib.sha1(path).hexdigest())
+
+def write_blocks(blocksdir, path, record):
+    """Store block digests record (size, mtime, block size, hex digest and
+    list of block hex digests) of a given file. Does not return anything.
+    """
+    blockspath = blocks_path(blocksdir, path)
+    blocksfile = open(blockspath + '.tmp', 'wb')
+    try:
+        cPickle.dump(record, blocksfile, -1)
+    finally:
+        blocksfile.close()
+    os.rename(blockspath + '.tmp', blockspath)
+
+def read_blocks(blocksdir, path):
+    """Read block digests record of a given file. Returns record or None
+    if there is none.
+    """
+    try:
+        blocksfile = open(blocks_path(blocksdir, path), 'rb')
+        try:
+            return cPickle.load(blocksfile)
+        finally:
+            blocksfile.close()
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+
+def move_blocks(blocksdir, src, dst):
+    """Move block digests record from one path to another or remove it if
+    dst is None. Does not return anything.
+    """
+    try:
+        if dst:
+            os.rename(blocks_path(blocksdir, src), blocks_path(blocksdir,
+                dst))
+        else:
+            os.remove(blocks_path(blocksdir, src))
+    except OSError:
+        pass
+
+def stat_signature(mystat):
+    """Returns tuple of stat fields which change whenever file content,
+    mode, ownership or identity changes.
+    """
+    return (mystat.st_size, mystat.st_mtime, mystat.st_ino, mystat.st_mode,
+            mystat.st_uid, mystat.st_gid)
+
+def changes_since(actionmap, sequence):
+    """Change feed of action map {path: (action, sequence, ...)}: entries
+    changed after a given sequence number (cursor of a consumer), oldest
+    first, looked up in its change log. Returns list of (sequence, path,
+    entry) tuples.
+    """
+    log = actionmap.log
+    changes = []
+    for i in xrange(bisect.bisect_left(log, (sequence + 1,)), len(log)):
+        mysequence, path = log[i]
+        entry = actionmap.get(path)
+        # skip paths removed or changed again since
+        if entry is not None and entry[1] == mysequence:
+            changes.append((mysequence, path, entry))
+    return changes
+
+def find_root(path, roots):
+    """Find watch root a path belongs to. Returns (root, relpath) or
+    (None, None) if it is outside of all roots.
+    """
+    for root in roots:
+        if path.startswith(root['path'] + '/'):
+            return root, path[len(root['path']) + 1:]
+    return None, None
+
+def glob_regex(pattern):
+    """Translate fnmatch(3) pattern into regular expression where
+    wildcards do not match slash. Returns regular expression string.
+    """
+    i, n, regex = 0, len(pattern), ''
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and pattern.find(']', i + 1) != -1:
+            j = pattern.find(']', i + 1)
+            chars = pattern[i:j].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[%s]' % chars
+            i = j + 1
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+class PathFilter(object):
+    """Include/exclude policy, each compiled into a single regular
+    expression matched against path relative to its watch root. Patterns
+    without slash match any path component, those with slash match from
+    watch root on; a match covers everything below it too.
+    """
+    def __init__(self, include, exclude, roots):
+        self.roots = roots
+        self.include = self.compile(include)
+        self.exclude = self.compile(exclude)
+
+    def compile(self, patterns):
+        """Returns combined regular expression of patterns or None if
+        there are none.
+        """
+        if not patterns:
+            return None
+        regexes = []
+        for pattern in patterns:
+            pattern = pattern.strip('/')
+            if '/' in pattern:
+                regexes.append('^%s(?:/|$)' % glob_regex(pattern))
+            else:
+                regexes.append('(?:^|/)%s(?:/|$)' % glob_regex(pattern))
+        return re.compile('|'.join(regexes))
+
+    def check(self, path, isdir=False):
+        """Check if path is to be replicated; inclusion applies to files
+        only, so that directories are still walked. Returns None if yes,
+        otherwise reason ('excluded' or 'not included').
+        """
+        _, relpath = find_root(path, self.roots)
+        if relpath is None:
+            return None
+        if self.exclude and self.exclude.search(relpath):
+            return 'excluded'
+        if self.include and not isdir and not self.include.search(relpath):
+            return 'not included'
+        return None
+
+
+class RootScheduler(object):
+    """Stride scheduling across watch roots: roots with work pending get
+    served in proportion to their priorities, and a root which has been
+    idle does not get to catch up on the others in a burst.
+    """
+    def __init__(self, roots):
+        self.strides = dict([(root['name'], 1.0 / root.get('priority', 1))
+            for root in roots])
+        self.passes = {}
+        self.vtime = 0.0
+
+    def pick(self, names, cost=1.0):
+        """Pick root to serve next among names of roots with work pending
+        and charge it cost of one turn. Returns name.
+        """
+        for name in names:
+            if self.passes.setdefault(name, 0.0) < self.vtime:
+                self.passes[name] = self.vtime
+        name = min(names, key=lambda x: self.passes[x])
+        self.vtime = self.passes[name]
+        self.passes[name] += self.strides.get(name, 1.0) * cost
+        return name
+
+    def charge(self, name, cost):
+        """Charge root for work done on its behalf which is known only
+        afterwards (such as time it took). Does not return anything.
+        """
+        self.passes[name] = self.passes.get(name, self.vtime) + \
+                self.strides.get(name, 1.0) * cost
+
+
+def share_atomic(path):
+    """Keep object of a status file in memory from now on: it is read from
+    file only once, and written to file only by checkpoint_atomic(). Does
+    not return anything.
+    """
+    SharedPaths.append(path)
+
+def checkpoint_atomic():
+    """Write changed in-memory objects of shared status files into their
+    files. Does not return anything.
+    """
+    for path in SharedPaths:
+        flush_atomic(path)
+
+def flush_atomic(path):
+    """Write changed in-memory object of a shared status file into its file
+    right away, ahead of next checkpoint. Does not return anything.
+    """
+    if path in SharedDirty:
+        dump_atomic(path, SharedObjects[path])
+        SharedDirty.discard(path)
+
+def sync_atomic(path):
+    """Make file written by write_atomic() durable, together with its
+    directory entry. Does not return anything.
+    """
+    fsync_path(path)
+    fsync_path(os.path.dirname(path) or '.')
+
+def fsync_path(path):
+    """Flush file or directory to disk. Does not return anything.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def write_atomic(path, myobject):
+    """Serialize and write atomically an object into file with locking
+    (or just keep it if file is shared in memory). Does not return
+    anything.
+    """
+    if path in SharedPaths:
+        SharedObjects[path] = myobject
+        SharedDirty.add(path)
+        return
+    dump_atomic(path, myobject)
+
+def dump_atomic(path, myobject):
     """Serialize and write atomically an object into file with locking.
     Does not return anything.
     """
@@ -69,6 +310,17 @@ def write_atomic(path, myobject):
         lockfile.close()
 
 def read_atomic(path):
+    """Read from file and serialize with locking (or only once if file
+    is shared in memory). Returns unserialized unpickled object.
+    """
+    if path in SharedObjects:
+        return SharedObjects[path]
+    myobject = load_atomic(path)
+    if path in SharedPaths:
+        SharedObjects[path] = myobject
+    return myobject
+
+def load_atomic(path):
     """Read from file and serialize with locking. Returns unserialized
     unpickled object.
     """
@@ -85,41 +337,240 @@ def read_atomic(path):
         lockfile.close()
     return myobject
 
-def run_with_timeout(args, cwd=None, shell=False, kill_tree=True,
-        timeout=-1):
-    """Run a command with a timeout after which it will be forcibly
-    killed. (c) Alex Martelli
+def trim_atomic(path, count):
+    """Remove count oldest items from serialized deque in file, holding the
+    lock over both read and write, so that items appended meanwhile are
+    kept. Does not return anything.
     """
-    class Alarm(Exception):
-        pass
-    def alarm_handler(signum, frame):
-        raise Alarm
-    p = subprocess.Popen(args, shell=shell, cwd=cwd,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if timeout != -1:
-        signal.signal(signal.SIGALRM, alarm_handler)
-        signal.alarm(timeout)
+    if path in SharedPaths:
+        myobject = read_atomic(path)
+        for i in xrange(min(count, len(myobject))):
+            myobject.popleft()
+        write_atomic(path, myobject)
+        return
+    lockfile = open(path + '.lock', 'a')
+    fcntl.flock(lockfile, fcntl.LOCK_EX)
+    picklefile = None
     try:
-        stdout, stderr = p.communicate()
+        try:
+            picklefile = open(path, 'rb')
+            myobject = cPickle.load(picklefile)
+        finally:
+            if picklefile:
+                picklefile.close()
+        for i in xrange(min(count, len(myobject))):
+            myobject.popleft()
+        picklefile = None
+        try:
+            picklefile = open(path + '.tmp', 'wb')
+            cPickle.dump(myobject, picklefile, -1)
+        finally:
+            if picklefile:
+                picklefile.close()
+        os.rename(path + '.tmp', path)
+    finally:
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        lockfile.close()
+
+
+class ActionMap(dict):
+    """Action map {path: (action, sequence, ...)} which also keeps change
+    log of (sequence, path) in sequence order, pickled along with it, so
+    that changes_since() does not have to scan and sort the whole map.
+    Log items of removed or overwritten entries are dropped once they make
+    up most of the log.
+    """
+    def __init__(self, entries=()):
+        if entries is None:
+            # being unpickled, log comes with the state
+            self.log = None
+            return
+        dict.__init__(self, entries)
+        self.log = sorted([(entry[1], path) for path, entry in
+            self.iteritems()])
+
+    def __reduce__(self):
+        return (self.__class__, (None,), self.log, None, self.iteritems())
+
+    def __setstate__(self, log):
+        self.log = log
+
+    def __setitem__(self, path, entry):
+        dict.__setitem__(self, path, entry)
+        if self.log is None:
+            return
+        item = (entry[1], path)
+        if self.log and item < self.log[-1]:
+            bisect.insort(self.log, item)
+        else:
+            self.log.append(item)
+        if len(self.log) > 2 * len(self) + 1000:
+            self.log = [(x, y) for x, y in self.log
+                    if y in self and dict.__getitem__(self, y)[1] == x]
+
+
+class RunningProcess(object):
+    """Child process started by ProcessRunner, with its deadline and
+    captured output; returncode is None until it has finished.
+    """
+    def __init__(self, popen, deadline, limit):
+        self.popen = popen
+        self.deadline = deadline
+        self.limit = limit
+        self.stdout = popen.stdout.fileno()
+        self.stderr = popen.stderr.fileno()
+        self.pipes = {self.stdout: popen.stdout, self.stderr: popen.stderr}
+        self.output = {self.stdout: [], self.stderr: []}
+        self.sizes = {self.stdout: 0, self.stderr: 0}
+        self.returncode = None
+
+    def capture(self, fd, data):
+        """Keep output read from fd, up to limit bytes. Does not return
+        anything.
+        """
+        if self.limit is not None:
+            data = data[:max(0, self.limit - self.sizes[fd])]
+        if data:
+            self.output[fd].append(data)
+            self.sizes[fd] += len(data)
+
+    def result(self):
+        """Returns return code, stdout and stderr just like
+        run_with_timeout().
+        """
+        return (self.returncode, ''.join(self.output[self.stdout]),
+                ''.join(self.output[self.stderr]))
+
+
+class ProcessRunner(object):
+    """Runs many child processes at once from a single thread. Every
+    process gets its own process group and deadline after which the whole
+    group is killed, while its stdout and stderr are captured into buffers
+    of bounded size as they come.
+    """
+    def __init__(self):
+        self.poller = select.poll()
+        # open pipes {fd: process}
+        self.fds = {}
+        self.processes = []
+
+    def spawn(self, args, timeout=-1, cwd=None, shell=False,
+            limit=OUTPUT_LIMIT):
+        """Start a command, to be killed after timeout seconds (-1 means
+        never) and keeping at most limit bytes of each output (None means
+        everything). Returns RunningProcess.
+        """
+        popen = subprocess.Popen(args, shell=shell, cwd=cwd,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                close_fds=True, preexec_fn=os.setsid)
+        deadline = None
         if timeout != -1:
-            signal.alarm(0)
-    except Alarm:
-        pids = [p.pid]
-        if kill_tree:
-            pids.extend(get_process_children(p.pid))
-        for pid in pids:
-            os.kill(pid, signal.SIGKILL)
-        return -9, '', ''
-    return p.returncode, stdout, stderr
-
-def get_process_children(pid):
-    """Get all children from a given PID. (c) Alex Martelli
-    """
-    p = subprocess.Popen('ps --no-headers -o pid --ppid %d' % pid,
-            shell = True, stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    return [int(p) for p in stdout.split()]
+            deadline = time.time() + timeout
+        process = RunningProcess(popen, deadline, limit)
+        for fd in process.pipes:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+                    os.O_NONBLOCK)
+            self.fds[fd] = process
+            self.poller.register(fd, select.POLLIN | select.POLLPRI)
+        self.processes.append(process)
+        return process
+
+    def close(self, fd):
+        """Stop watching a pipe. Does not return anything.
+        """
+        process = self.fds.pop(fd)
+        self.poller.unregister(fd)
+        process.pipes[fd].close()
+
+    def read(self, fd):
+        """Read whatever is available on a pipe, closing it on end of
+        file. Does not return anything.
+        """
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno == errno.EAGAIN:
+                    return
+                data = ''
+            if not data:
+                self.close(fd)
+                return
+            self.fds[fd].capture(fd, data)
+
+    def kill(self, process):
+        """Kill process and its whole process group. Does not return
+        anything.
+        """
+        try:
+            os.killpg(process.popen.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        for fd in self.fds.keys():
+            if self.fds[fd] is process:
+                self.close(fd)
+        process.popen.wait()
+        process.returncode = -9
+
+    def poll(self, timeout=0):
+        """Wait at most timeout seconds for output, then collect finished
+        processes and kill those past their deadline. Returns number of
+        processes still running.
+        """
+        if not self.processes:
+            time.sleep(timeout)
+            return 0
+
+        # do not sleep past the nearest deadline
+        now = time.time()
+        deadlines = [p.deadline for p in self.processes
+                if p.deadline is not None]
+        if deadlines:
+            timeout = max(0, min([timeout] + [d - now for d in deadlines]))
+        # pipes closed, process is about to exit
+        if len(set(self.fds.values())) < len(self.processes):
+            timeout = min(timeout, 0.01)
+        try:
+            events = self.poller.poll(timeout * 1000)
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, _ in events:
+            if fd in self.fds:
+                self.read(fd)
+
+        now = time.time()
+        for process in self.processes[:]:
+            if process.deadline is not None and process.deadline <= now:
+                self.kill(process)
+            elif process.popen.poll() is not None:
+                # exited, take what is left in pipes and don't wait for
+                # anything left running in background holding them open
+                for fd in self.fds.keys():
+                    if self.fds[fd] is process:
+                        self.read(fd)
+                        if fd in self.fds:
+                            self.close(fd)
+                process.returncode = process.popen.returncode
+            else:
+                continue
+            self.processes.remove(process)
+        return len(self.processes)
+
+
+def run_with_timeout(args, cwd=None, shell=False, timeout=-1):
+    """Run a command with a timeout after which it (with its whole process
+    group) will be forcibly killed. Returns return code (-9 if killed),
+    stdout and stderr.
+    """
+    runner = ProcessRunner()
+    process = runner.spawn(args, timeout, cwd=cwd, shell=shell, limit=None)
+    while runner.poll(1):
+        pass
+    return process.result()
 
 def setup_logging(progname, console_loglevel, file_loglevel, logfmt,
         logfile, datefmt):
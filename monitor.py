@@ -26,11 +26,13 @@ __version__ = '$Id: monitor.py,v de859cceb463 2010/10/28 09:10:17 dinko $'
 
 import time
 import os
+import stat
 import sys
+import collections
 import pyinotify
 
 from common import write_atomic, read_atomic, setup_logging, parse_argv, \
-    daemonize
+    daemonize, stat_signature, find_root, PathFilter, ActionMap
 from settings import *
 
 
@@ -46,7 +48,39 @@ InotifyMask = {pyinotify.IN_CREATE: 'created',
         pyinotify.IN_ATTRIB|pyinotify.IN_ISDIR: 'attrib_dir',
         pyinotify.IN_MOVED_TO|pyinotify.IN_ISDIR: 'created_dir',
         pyinotify.IN_MOVED_FROM|pyinotify.IN_ISDIR: 'deleted_dir'}
-FilesActionMap = {}
+# catch only create/delete/modify/attrib events; don't monitor IN_MODIFY,
+# instead use IN_CLOSE_WRITE when file has been written to and finally
+# closed; and monitor IN_MOVED_TO when using temporary files for atomicity
+# as well as IN_MOVED_FROM when file is moved from watched path
+EVENT_MASK = pyinotify.IN_CREATE|pyinotify.IN_DELETE|\
+        pyinotify.IN_CLOSE_WRITE|pyinotify.IN_ATTRIB|\
+        pyinotify.IN_MOVED_TO|pyinotify.IN_MOVED_FROM|\
+        pyinotify.IN_ISDIR|pyinotify.IN_UNMOUNT|\
+        pyinotify.IN_Q_OVERFLOW
+# renames and what they become if anything else happens to them before
+# summer gets to them
+MOVED_ACTIONS = {'moved': 'moved_changed',
+        'moved_changed': 'moved_changed',
+        'moved_dir': 'moved_dir_changed',
+        'moved_dir_changed': 'moved_dir_changed'}
+FilesActionMap = ActionMap()
+# last change sequence number handed out and how far it is reserved in
+# FILES_SEQUENCE_FILE
+Sequence = 0
+SequenceReserved = 0
+MovedFrom = {}
+# set on inotify queue overflow, rescan is done from notifier loop
+RescanPending = False
+LastRescan = 0
+Budget = None
+# progressive watch registration in progress, see register_roots()
+Registration = None
+RegistrationStart = 0
+RootPaths = set([root['path'] for root in WATCH_ROOTS])
+Filter = PathFilter(INCLUDE_PATTERNS, EXCLUDE_PATTERNS, WATCH_ROOTS)
+# events dropped by filter {reason: count}, logged every minute
+Dropped = {}
+LastDropped = ({}, 0)
 logger = None
 foreground = False
 
@@ -62,8 +96,11 @@ class ProcessEventHandler(pyinotify.ProcessEvent):
         sys.exit(1)
 
     def process_IN_Q_OVERFLOW(self, event):
-        logger.critical('Detected inotify queue overflow. Bailing out.')
-        sys.exit(1)
+        global RescanPending
+
+        logger.warn('Detected inotify queue overflow. Scheduling rescan.')
+        RescanPending = True
+        raise_queue_limit()
 
     def process_default(self, event):
         global FilesActionMap
@@ -75,59 +112,620 @@ class ProcessEventHandler(pyinotify.ProcessEvent):
                     event.mask)
             return
 
+        # transient and irrelevant files
+        reason = Filter.check(event.pathname, event.dir)
+        if reason:
+            Dropped[reason] = Dropped.get(reason, 0) + 1
+            return
+
+        # directory activity keeps its watch from being traded for a poll
+        Budget.touch(event.path)
+
+        # renames between watch roots are removals and creations, as each
+        # root has its own remote directory; so are renames of files which
+        # have been filtered out so far
+        renamed = hasattr(event, 'src_pathname') and \
+                find_root(event.src_pathname, WATCH_ROOTS)[0] is \
+                find_root(event.pathname, WATCH_ROOTS)[0] and \
+                Filter.check(event.src_pathname, event.dir) is None
+        if event.mask & pyinotify.IN_ISDIR:
+            # moved away directory is forgotten only if it does not show up
+            # within watched tree, see expire_moved()
+            if event.mask & pyinotify.IN_DELETE:
+                Budget.forget(event.pathname)
+            # watches and polls below renamed directory follow it (or it
+            # would be reported under its old path)
+            if event.mask & pyinotify.IN_MOVED_TO and \
+                    hasattr(event, 'src_pathname'):
+                Budget.move(event.src_pathname, event.pathname)
+                # not moved away, but from another watch root
+                if not renamed:
+                    MovedFrom.pop(event.src_pathname, None)
+            # new directory might have been filled before it got watched
+            # (or auto_add did not watch it at all)
+            if event.mask & (pyinotify.IN_CREATE|pyinotify.IN_MOVED_TO) \
+                    and not renamed:
+                drifted = {}
+                Budget.add_tree(event.pathname, drifted)
+                record_drifted(drifted)
+
         # map and process individual actions
         FilesActionMap = read_atomic(FILES_STATUS_FILE)
         action = InotifyMask[event.mask]
-        FilesActionMap[event.pathname] = (action, time.time())
+        pending = FilesActionMap.get(event.pathname)
+
+        # moved away, remember what was pending in case this turns out to
+        # be a rename within watched tree
+        if event.mask & pyinotify.IN_MOVED_FROM:
+            record_moved_from(event.pathname, pending)
+            FilesActionMap[event.pathname] = (action, next_sequence())
+
+        # renamed within watched tree (pyinotify paired IN_MOVED_FROM and
+        # IN_MOVED_TO by their cookie)
+        elif event.mask & pyinotify.IN_MOVED_TO and renamed:
+            record_moved_to(event.src_pathname, event.pathname,
+                    bool(event.mask & pyinotify.IN_ISDIR))
+
+        # moved and then deleted before summer got to it, remove the
+        # source instead
+        elif pending and pending[0] in MOVED_ACTIONS and \
+                action in ('deleted', 'deleted_dir'):
+            FilesActionMap[event.pathname] = (action, next_sequence())
+            if pending[2] not in FilesActionMap:
+                FilesActionMap[pending[2]] = (action, next_sequence())
+
+        # moved and then changed, keep the move but recheck afterwards
+        elif pending and pending[0] in MOVED_ACTIONS:
+            FilesActionMap[event.pathname] = (MOVED_ACTIONS[pending[0]],
+                    next_sequence(), pending[2])
+
+        else:
+            FilesActionMap[event.pathname] = (action, next_sequence())
         write_atomic(FILES_STATUS_FILE, FilesActionMap)
         logger.debug('Pending monitor actions %s.' % FilesActionMap)
 
-def main(argv):
+class WatchBudget(object):
+    """Keeps number of inotify watches within budget and covers the
+    remaining directories with an incremental stat poller. Polled
+    directories which show activity are swapped with idle watched ones.
+    """
+    def __init__(self, watch_manager):
+        self.watch_manager = watch_manager
+        self.limit = MAX_WATCHES
+        if self.limit is None:
+            self.limit = max(pyinotify.max_user_watches.value -
+                    WATCH_RESERVE, 1)
+        # polled directory: {name: stat signature} as of last poll
+        self.polled = {}
+        self.rotation = collections.deque()
+        # directories waiting for watches released by demotion
+        self.waiting = collections.deque()
+        # watched directory: time of last event, coldest first
+        self.active = collections.OrderedDict()
+        self.last_poll = time.time()
+
+    def full(self):
+        """Returns True if no more watches fit into budget."""
+        return len(self.watch_manager.watches) >= self.limit
+
+    def touch(self, path):
+        """Record activity in watched directory. Does not return
+        anything.
+        """
+        self.active.pop(path, None)
+        self.active[path] = time.time()
+
+    def adopt(self):
+        """Make watches registered at startup demotion candidates, idle
+        since ever. Does not return anything.
+        """
+        cold = collections.OrderedDict()
+        for watch_ in self.watch_manager.watches.itervalues():
+            if watch_.path not in self.active:
+                cold[watch_.path] = 0
+        cold.update(self.active)
+        self.active = cold
+
+    def add(self, path, fresh=False):
+        """Watch directory if budget allows, otherwise poll it; if fresh
+        is set its entries are all reported on first poll. Returns True if
+        watched.
+        """
+        if self.watch_manager.get_wd(path) is not None:
+            # watched by auto_add, make it a demotion candidate
+            if path not in self.active:
+                self.active[path] = time.time()
+            return True
+        if not self.full():
+            wd = self.watch_manager.add_watch(path, EVENT_MASK,
+                    auto_add=True).get(path, -1)
+            if wd >= 0:
+                self.polled.pop(path, None)
+                self.touch(path)
+                return True
+        self.poll(path, fresh)
+        return False
+
+    def add_tree(self, path, drifted):
+        """Add new directory and, if it got watched, record its entries
+        into drifted as they were created before the watch. Does not
+        return anything.
+        """
+        if not self.add(path, True):
+            # first poll reports them
+            return
+        for name, mysignature in (self.snapshot(path) or {}).iteritems():
+            mypath = os.path.join(path, name)
+            if stat.S_ISDIR(mysignature[3]):
+                drifted[mypath] = 'created_dir'
+                self.add_tree(mypath, drifted)
+            else:
+                drifted[mypath] = 'created'
+
+    def poll(self, path, fresh=False):
+        """Start polling directory. Does not return anything."""
+        if path not in self.polled:
+            self.rotation.append(path)
+        if fresh:
+            self.polled[path] = {}
+        else:
+            self.polled[path] = self.snapshot(path) or {}
+
+    def move(self, src, dst):
+        """Follow directory renamed within watched tree: watches and poll
+        state of it and everything below it get new paths. Does not return
+        anything.
+        """
+        self.watch_manager.move_path(src, dst)
+        prefix = src + '/'
+        for mymap in (self.polled, self.active):
+            for mypath in mymap.keys():
+                if mypath == src or mypath.startswith(prefix):
+                    mymap[dst + mypath[len(src):]] = mymap.pop(mypath)
+        for queue in (self.rotation, self.waiting):
+            for i in xrange(len(queue)):
+                mypath = queue.popleft()
+                if mypath == src or mypath.startswith(prefix):
+                    mypath = dst + mypath[len(src):]
+                queue.append(mypath)
+        # poller might have found it gone before rename got reported
+        if self.watch_manager.get_wd(dst) is None and \
+                dst not in self.polled:
+            self.add(dst)
+
+    def unwatch(self, path):
+        """Remove watches of directory and everything below it. Does not
+        return anything.
+        """
+        wds = self.watch_manager.get_sub_wds(path)
+        if wds:
+            self.watch_manager.rm_watch(wds)
+
+    def forget(self, path):
+        """Stop polling directory and everything below it. Does not
+        return anything.
+        """
+        prefix = path + '/'
+        for mymap in (self.polled, self.active):
+            for mypath in mymap.keys():
+                if mypath == path or mypath.startswith(prefix):
+                    del mymap[mypath]
+
+    def snapshot(self, path):
+        """Returns {name: stat signature} of directory entries or None if
+        directory is gone.
+        """
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return None
+        entries = {}
+        for name in names:
+            mypath = os.path.join(path, name)
+            try:
+                mysignature = stat_signature(os.lstat(mypath))
+            except OSError:
+                continue
+            if Filter.check(mypath, stat.S_ISDIR(mysignature[3])) is None:
+                entries[name] = mysignature
+        return entries
+
+    def demote(self):
+        """Trade the watch of a directory idle for WATCH_COLD_AGE for a
+        poll. Returns True if one was found.
+        """
+        # coldest first, up to the first one which is not idle enough
+        now = time.time()
+        stale = []
+        found = None
+        for path, since in self.active.iteritems():
+            if now - since <= WATCH_COLD_AGE:
+                break
+            if path in RootPaths:
+                continue
+            if path in self.polled or \
+                    self.watch_manager.get_wd(path) is None:
+                stale.append(path)
+                continue
+            found = path
+            break
+        for path in stale:
+            del self.active[path]
+        if found is None:
+            return False
+        # watch entry itself goes away with IN_IGNORED
+        self.watch_manager.rm_watch(self.watch_manager.get_wd(found))
+        del self.active[found]
+        self.poll(found)
+        return True
+
+    def enforce(self):
+        """Demote idle watches over budget (auto_add does not know about
+        it) and hand released ones to waiting directories. Does not return
+        anything.
+        """
+        excess = len(self.watch_manager.watches) - self.limit
+        while excess > 0 and self.demote():
+            excess -= 1
+        while self.waiting and not self.full():
+            path = self.waiting.popleft()
+            if path in self.polled:
+                self.add(path)
+
+    def step(self):
+        """Poll directories due since last step at POLL_RATE per second.
+        Returns {path: action} of detected changes.
+        """
+        now = time.time()
+        count = min(int((now - self.last_poll) * POLL_RATE),
+                len(self.rotation))
+        drifted = {}
+        if count == 0:
+            return drifted
+        self.last_poll = now
+        for i in xrange(count):
+            path = self.rotation.popleft()
+            if path not in self.polled:
+                continue
+            entries = self.snapshot(path)
+            # gone, its parent reports it
+            if entries is None:
+                del self.polled[path]
+                continue
+            self.rotation.append(path)
+            old = self.polled[path]
+            self.polled[path] = entries
+            if self.compare(path, old, entries, drifted):
+                # active now, swap it for an idle watch
+                self.waiting.append(path)
+                if self.full():
+                    self.demote()
+        return drifted
+
+    def compare(self, path, old, new, drifted):
+        """Record differences between two snapshots of directory into
+        drifted. Returns True if any.
+        """
+        count = len(drifted)
+        for name, mysignature in new.iteritems():
+            mypath = os.path.join(path, name)
+            oldsignature = old.get(name)
+            isdir = stat.S_ISDIR(mysignature[3])
+            if oldsignature is None:
+                if isdir:
+                    drifted[mypath] = 'created_dir'
+                    self.add_tree(mypath, drifted)
+                else:
+                    drifted[mypath] = 'created'
+            # directory mtime moves with its entries, look only at
+            # mode and ownership
+            elif isdir:
+                if oldsignature[3:] != mysignature[3:]:
+                    drifted[mypath] = 'attrib_dir'
+            elif oldsignature[:3] != mysignature[:3]:
+                drifted[mypath] = 'changed'
+            elif oldsignature != mysignature:
+                drifted[mypath] = 'attrib'
+        for name, oldsignature in old.iteritems():
+            if name not in new:
+                mypath = os.path.join(path, name)
+                if stat.S_ISDIR(oldsignature[3]):
+                    drifted[mypath] = 'deleted_dir'
+                    self.forget(mypath)
+                else:
+                    drifted[mypath] = 'deleted'
+        return len(drifted) > count
+
+def next_sequence():
+    """Hand out next change sequence number, reserving a new block of
+    SEQUENCE_BLOCK numbers on disk when the current one is used up, so
+    numbers keep growing across restarts. Returns sequence number.
+    """
+    global Sequence
+    global SequenceReserved
+
+    Sequence += 1
+    if Sequence > SequenceReserved:
+        SequenceReserved = Sequence + SEQUENCE_BLOCK - 1
+        write_atomic(FILES_SEQUENCE_FILE, SequenceReserved)
+    return Sequence
+
+def record_moved_from(path, pending):
+    """Remember action pending on a path which has just been moved away.
+    Does not return anything.
+    """
+    MovedFrom[path] = (pending, time.time())
+
+def expire_moved():
+    """Forget unpaired (moved out of watched tree) records, and watches
+    which would report what happens to moved away directory under its old
+    path. Does not return anything.
+    """
+    for oldpath in MovedFrom.keys():
+        if time.time() - MovedFrom[oldpath][1] > 60:
+            del MovedFrom[oldpath]
+            Budget.unwatch(oldpath)
+            Budget.forget(oldpath)
+
+def record_moved_to(src, dst, isdir):
+    """Record rename of src to dst in action map. Does not return
+    anything.
+    """
     global FilesActionMap
-    global logger
-    global foreground
 
-    # parse argv
-    parse_argv(argv, globals())
+    pending, _ = MovedFrom.pop(src, (None, None))
+    FilesActionMap.pop(src, None)
+    if isdir:
+        action = 'moved_dir'
+    else:
+        action = 'moved'
 
-    # daemonize
-    daemonize(MONITOR_PID, foreground)
+    # no pending action means source has been replicated already
+    if pending is None:
+        FilesActionMap[dst] = (action, next_sequence(), src)
+    # renamed again, move from the original source
+    elif pending[0] in MOVED_ACTIONS:
+        FilesActionMap[dst] = (pending[0], next_sequence(), pending[2])
+    # source has not been replicated yet, nothing to move remotely
+    elif pending[0] in ('created', 'created_dir'):
+        FilesActionMap[dst] = (pending[0], next_sequence())
+    # pending changes, move and then recheck
+    else:
+        FilesActionMap[dst] = (MOVED_ACTIONS[action], next_sequence(), src)
 
-    # initialize logging
-    logger = setup_logging(argv[0], CONSOLE_LOG_LEVEL, FILE_LOG_LEVEL,
-            LOG_FORMAT, MONITOR_LOG, DATE_FORMAT)
+    # carry along actions pending below renamed directory, as new changes
+    # of their new paths
+    if isdir:
+        prefix = src + '/'
+        for path in FilesActionMap.keys():
+            if path.startswith(prefix):
+                entry = FilesActionMap.pop(path)
+                FilesActionMap[dst + path[len(src):]] = (entry[0],
+                        next_sequence()) + entry[2:]
+
+def raise_queue_limit():
+    """Double kernel inotify event queue size up to
+    INOTIFY_MAX_QUEUED_EVENTS if permitted. New size applies only to inotify
+    instances created afterwards. Does not return anything.
+    """
+    try:
+        current = pyinotify.max_queued_events.value
+        if current < INOTIFY_MAX_QUEUED_EVENTS:
+            wanted = min(current * 2, INOTIFY_MAX_QUEUED_EVENTS)
+            pyinotify.max_queued_events.value = wanted
+            logger.warn('Raised inotify max_queued_events from %d to %d.' %
+                    (current, wanted))
+    except (IOError, OSError), e:
+        logger.info('Could not raise inotify max_queued_events: %s.' % e)
+
+def check_rescan():
+    """Runs pending rescan unless one has been done during last
+    RESCAN_INTERVAL seconds. Does not return anything.
+    """
+    if RescanPending and time.time() - LastRescan >= RESCAN_INTERVAL:
+        rescan()
+
+def rescan(all_dirs=False):
+    """Walk watched tree and compare stat signatures against hash map,
+    recording only paths which drifted (events lost on queue overflow or
+    while monitor was not running). Directories neither watched nor polled
+    are added to watch budget; if all_dirs is set every directory is
+    recorded. Does not return anything.
+    """
+    global RescanPending
+    global LastRescan
+
+    RescanPending = False
+    LastRescan = start = time.time()
+    try:
+        FilesHashMap = read_atomic(FILES_HASH_FILE)
+    except (IOError, AttributeError, EOFError):
+        FilesHashMap = {}
+    drifted = {}
+    seen = set()
+
+    for root, dirs, files in walk_roots():
+        for name in files:
+            path = os.path.join(root, name)
+            seen.add(path)
+            try:
+                mysignature = stat_signature(os.lstat(path))
+            except OSError:
+                continue
+            entry = FilesHashMap.get(path)
+            if entry is None:
+                drifted[path] = 'created'
+            # entries without signature predate it, recheck them
+            elif len(entry) < 3 or entry[2] != mysignature:
+                drifted[path] = 'changed'
+        for name in dirs:
+            path = os.path.join(root, name)
+            if Budget.watch_manager.get_wd(path) is None and \
+                    path not in Budget.polled:
+                Budget.add(path)
+                drifted[path] = 'created_dir'
+            elif all_dirs:
+                drifted[path] = 'created_dir'
+
+    # known files which disappeared meanwhile
+    for path in FilesHashMap:
+        if path not in seen:
+            drifted[path] = 'deleted'
+
+    record_drifted(drifted)
+    logger.warn('Rescan of %d files took %.1fs, %d paths drifted, '
+            '%d directories watched and %d polled.' % (len(seen),
+                time.time() - start, len(drifted),
+                len(Budget.watch_manager.watches), len(Budget.polled)))
+
+def walk_roots():
+    """Walk all watch roots, skipping filtered out paths. Returns
+    os.walk() like generator.
+    """
+    for root in WATCH_ROOTS:
+        for path, dirs, files in os.walk(root['path']):
+            dirs[:] = [x for x in dirs
+                if Filter.check(os.path.join(path, x), True) is None]
+            files[:] = [x for x in files
+                if Filter.check(os.path.join(path, x)) is None]
+            yield path, dirs, files
+
+def watch_excluded(path):
+    """Exclusion filter of watch manager. Returns True if directory is
+    not to be watched.
+    """
+    return Filter.check(path, True) is not None
+
+def report_dropped():
+    """Log counts of events dropped by filter once a minute if they have
+    changed. Does not return anything.
+    """
+    global LastDropped
+
+    if Dropped != LastDropped[0] and time.time() - LastDropped[1] >= 60:
+        logger.info('Dropped events: %s.' % ', '.join(['%d %s' %
+            (count, reason) for reason, count in sorted(Dropped.items())]))
+        LastDropped = (dict(Dropped), time.time())
+
+def record_drifted(drifted):
+    """Record changes found by stat'ing (not reported by inotify) into
+    action map. Does not return anything.
+    """
+    global FilesActionMap
+
+    FilesActionMap = read_atomic(FILES_STATUS_FILE)
+    for path, action in drifted.items():
+        pending = FilesActionMap.get(path)
+        # keep pending renames, but recheck afterwards
+        if pending and pending[0] in MOVED_ACTIONS:
+            if action not in ('deleted', 'deleted_dir'):
+                FilesActionMap[path] = (MOVED_ACTIONS[pending[0]],
+                        next_sequence(), pending[2])
+        else:
+            FilesActionMap[path] = (action, next_sequence())
+    write_atomic(FILES_STATUS_FILE, FilesActionMap)
+
+def register_roots(watch_manager):
+    """Register watches progressively on all watch roots, those with
+    higher priority first. Returns generator, see add_watch_progressive().
+    """
+    roots = sorted(WATCH_ROOTS, key=lambda x: -x.get('priority', 1))
+    for root in roots:
+        for batch in watch_manager.add_watch_progressive(root['path'],
+                EVENT_MASK, auto_add=True, batch=REGISTER_BATCH):
+            yield batch
+
+def notify_step(notifier, wait):
+    """Single iteration of notify loop: register next batch of watches
+    (catching up with a rescan once all are in place) or poll directories
+    over budget, then process events arriving within wait seconds, letting
+    them pile up and coalesce for that long. Does not return anything.
+    """
+    global Registration
+
+    watch_manager = Budget.watch_manager
+    notifier.process_events()
+    if Registration is not None:
+        try:
+            # the rest is polled
+            if Budget.full():
+                raise StopIteration
+            Registration.next()
+            # keep registering, only pick up events already there
+            wait = 0
+        except StopIteration:
+            Registration = None
+            Budget.adopt()
+            logger.warn('Registered %d watches in %.1fs. Catching up.' %
+                    (len(watch_manager.watches), time.time() -
+                        RegistrationStart))
+            # files changed before their directory got watched
+            rescan(all_dirs=True)
+    if Registration is None:
+        check_rescan()
+        drifted = Budget.step()
+        if drifted:
+            record_drifted(drifted)
+        Budget.enforce()
+        expire_moved()
+        report_dropped()
+    ref_time = time.time()
+    if notifier.check_events(int(wait * 1000)):
+        time.sleep(max(0, wait - (time.time() - ref_time)))
+        notifier.read_events()
+
+def setup():
+    """Check watch roots, recreate action map if needed and start inotify
+    monitor, registering watches progressively within budget. Returns
+    notifier.
+    """
+    global FilesActionMap
+    global Sequence
+    global SequenceReserved
+    global Budget
+    global Registration
+    global RegistrationStart
 
     # sanity check
-    if not os.path.isdir(WATCH_DIR):
-        logger.critical('Watched directory %s does not exist. '
-                'Bailing out.' % WATCH_DIR)
-        sys.exit(1)
+    for root in WATCH_ROOTS:
+        if not os.path.isdir(root['path']):
+            logger.critical('Watched directory %s does not exist. '
+                    'Bailing out.' % root['path'])
+            sys.exit(1)
 
     # if FilesActionMap is nonexistant or damaged, truncate it
     try:
-        FilesActionMap = read_atomic(FILES_STATUS_FILE)
+        FilesActionMap = ActionMap(read_atomic(FILES_STATUS_FILE))
     except (IOError, AttributeError, EOFError):
         logger.warn('Unusable action map status file %s. Recreating.' %
                 FILES_STATUS_FILE)
         pass
-    write_atomic(FILES_STATUS_FILE, FilesActionMap)
 
-    # initial recursive walk (initial events)
-    for root, dirs, files in os.walk(WATCH_DIR):
-        for name in files:
-            path = os.path.join(root, name)
-            FilesActionMap[path] = ('created', time.time())
-        for name in dirs:
-            path = os.path.join(root, name)
-            FilesActionMap[path] = ('created_dir', time.time())
+    # continue after the last reserved sequence number; entries of older
+    # versions carry timestamps instead and get renumbered
+    try:
+        SequenceReserved = read_atomic(FILES_SEQUENCE_FILE)
+    except (IOError, AttributeError, EOFError):
+        logger.warn('Unusable sequence file %s. Recreating.' %
+                FILES_SEQUENCE_FILE)
+    Sequence = SequenceReserved = max([SequenceReserved] +
+            [x[1] for x in FilesActionMap.values()
+                if isinstance(x[1], (int, long))])
+    for path, entry in FilesActionMap.items():
+        if isinstance(entry[1], float):
+            FilesActionMap[path] = (entry[0], next_sequence()) + entry[2:]
     write_atomic(FILES_STATUS_FILE, FilesActionMap)
-    logger.debug('Initial events %s. Commiting.' % FilesActionMap)
+
+    # bigger kernel queue makes overflows less likely, it has to be raised
+    # before inotify instance is created
+    raise_queue_limit()
 
     # start inotify monitor
-    watch_manager = pyinotify.WatchManager()
+    watch_manager = pyinotify.WatchManager(exclude_filter=watch_excluded)
     handler = ProcessEventHandler()
-    notifier = pyinotify.Notifier(watch_manager, default_proc_fun=handler,
-            read_freq=SLEEP_TIME)
+    notifier = pyinotify.Notifier(watch_manager, default_proc_fun=handler)
+    Budget = WatchBudget(watch_manager)
+    logger.debug('Watch budget is %d directories.' % Budget.limit)
 
     # try coalescing events if possible
     try:
@@ -136,22 +734,32 @@ def main(argv):
     except AttributeError:
         pass
 
-    # catch only create/delete/modify/attrib events; don't monitor
-    # IN_MODIFY, instead use IN_CLOSE_WRITE when file has been written to
-    # and finally closed; and monitor IN_MOVED_TO when using temporary
-    # files for atomicity as well as IN_MOVED_FROM when file is moved from
-    # watched path
-    event_mask = pyinotify.IN_CREATE|pyinotify.IN_DELETE|\
-            pyinotify.IN_CLOSE_WRITE|pyinotify.IN_ATTRIB|\
-            pyinotify.IN_MOVED_TO|pyinotify.IN_MOVED_FROM|\
-            pyinotify.IN_ISDIR|pyinotify.IN_UNMOUNT|\
-            pyinotify.IN_Q_OVERFLOW
-    watch_manager.add_watch(WATCH_DIR, event_mask, rec=True,
-            auto_add=True)
+    # initial events come from catch-up rescan once all watches are in
+    # place
+    Registration = register_roots(watch_manager)
+    RegistrationStart = time.time()
+    return notifier
+
+def main(argv):
+    global logger
+    global foreground
+
+    # parse argv
+    parse_argv(argv, globals())
+
+    # daemonize
+    daemonize(MONITOR_PID, foreground)
+
+    # initialize logging
+    logger = setup_logging(argv[0], CONSOLE_LOG_LEVEL, FILE_LOG_LEVEL,
+            LOG_FORMAT, MONITOR_LOG, DATE_FORMAT)
+
+    notifier = setup()
 
     # enter loop
     logger.debug('Inotify handler starting... Entering notify loop.')
-    notifier.loop()
+    while True:
+        notify_step(notifier, SLEEP_TIME)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -10,6 +10,7 @@
 # Source function library.
 . /etc/init.d/functions
 
+# single process mode: DAEMON="pipeline.py"
 DAEMON="monitor.py summer.py syncer.py"
 PATH=/opt/ActivePython-2.7/bin:$PATH
 BlackMesaDRPATH=/opt/BlackMesa-DR
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# crude memory benchmark of pyinotify watch and event objects: 1M watches
+# and a 100k events batch, slotted classes against the former dict-backed
+# ones (run from the top directory)
+# $Id: bench-watches.py,v de859cceb463 2010/10/28 09:10:17 dinko $
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
+import pyinotify
+
+WATCHES = 1000000
+EVENTS = 100000
+
+
+class DictWatch:
+    """Former dict-backed Watch."""
+    def __init__(self, wd, path, mask, proc_fun, auto_add, exclude_filter):
+        self.wd = wd
+        self.path = path
+        self.mask = mask
+        self.proc_fun = proc_fun
+        self.auto_add = auto_add
+        self.exclude_filter = exclude_filter
+        self.dir = True
+
+
+class DictEvent:
+    """Former dict-backed _RawEvent and Event."""
+    def __init__(self, dict_):
+        for tpl in dict_.items():
+            setattr(self, *tpl)
+
+
+def rss():
+    """Returns resident set size of this process in bytes."""
+    return int(open('/proc/self/statm').read().split()[1]) * \
+            os.sysconf('SC_PAGE_SIZE')
+
+def dict_watches():
+    return [DictWatch(wd, '/dare/VMwareDataRecovery/%d' % wd, 4095, None,
+        True, None) for wd in xrange(WATCHES)]
+
+def slotted_watches():
+    # skip isdir(2) on nonexistent paths, it is not what is measured
+    watches = []
+    for wd in xrange(WATCHES):
+        watch = pyinotify.Watch.__new__(pyinotify.Watch)
+        watch.wd, watch.path, watch.mask = wd, \
+                '/dare/VMwareDataRecovery/%d' % wd, 4095
+        watch.proc_fun, watch.auto_add, watch.exclude_filter = None, True, \
+                None
+        watch.dir = True
+        watches.append(watch)
+    return watches
+
+def dict_events():
+    events = []
+    for i in xrange(EVENTS):
+        name = 'file%d' % i
+        raw = DictEvent({'wd': 1, 'mask': 8, 'cookie': 0, 'name': name})
+        event = DictEvent({'wd': 1, 'mask': 8, 'path': '/dare', 'name': name,
+            'dir': False})
+        event.maskname = pyinotify.EventsCodes.maskname(8)
+        event.pathname = os.path.abspath(os.path.join('/dare', name))
+        events.append((raw, event))
+    return events
+
+def slotted_events():
+    events = []
+    for i in xrange(EVENTS):
+        name = 'file%d' % i
+        raw = pyinotify._RawEvent(1, 8, 0, name)
+        event = pyinotify.Event({'wd': 1, 'mask': 8, 'path': '/dare',
+            'name': name, 'dir': False})
+        # computed on first access, which every handled event gets
+        event.maskname
+        event.pathname
+        events.append((raw, event))
+    return events
+
+def measure(name, function):
+    """Build objects in a child process and report RSS growth, in total
+    and per object (they are kept referenced until RSS is read)."""
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    before = rss()
+    start = time.time()
+    objects = function()
+    elapsed = time.time() - start
+    growth = rss() - before
+    print '%-24s %8.1f MB %6d B/object %6.2f s' % (name,
+            growth / 1048576.0, growth / len(objects), elapsed)
+    os._exit(0)
+
+if __name__ == '__main__':
+    measure('dict watches (1M)', dict_watches)
+    measure('slotted watches (1M)', slotted_watches)
+    measure('dict events (100k)', dict_events)
+    measure('slotted events (100k)', slotted_events)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+"""Single process mode of BlackMesa Disaster Recovery project, running
+monitor, summer and syncer together
+"""
+
+__copyright__ = """Copyright (C) 2010  Dinko Korunic, InfoMAR
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+59 Temple Place, Suite 330, Boston, MA  02111-1307 USA
+"""
+
+__version__ = '$Id: pipeline.py,v de859cceb463 2010/10/28 09:10:17 dinko $'
+
+
+import time
+import sys
+import signal
+import atexit
+
+from common import setup_logging, parse_argv, daemonize, share_atomic, \
+    checkpoint_atomic
+from settings import *
+import monitor
+import summer
+import syncer
+
+
+logger = None
+foreground = False
+
+
+def checkpoint():
+    """Write in-memory status files for crash recovery. Does not return
+    anything.
+    """
+    start = time.time()
+    checkpoint_atomic()
+    logger.debug('Checkpoint took %.2fs.' % (time.time() - start))
+
+def terminate(signum, frame):
+    """Exit cleanly on SIGTERM so that status files get checkpointed. Does
+    not return.
+    """
+    logger.warn('Got signal %d. Checkpointing and exiting.' % signum)
+    sys.exit(0)
+
+def pipeline_step(notifier):
+    """Single round of all three stages: checksum one pending action
+    (unless summer is paused by backpressure), dispatch and reap remote
+    actions and process inotify events, waiting for them only when the
+    other stages are idle. Does not return anything.
+    """
+    summing = summer.decisionlogic()
+    syncing = syncer.decisionlogic()
+    if syncing:
+        syncer.Runner.poll(summing and 0 or 0.5)
+    if summing or syncing:
+        monitor.notify_step(notifier, 0)
+    else:
+        monitor.notify_step(notifier, SLEEP_TIME)
+
+def main(argv):
+    global logger
+    global foreground
+
+    # parse argv
+    parse_argv(argv, globals())
+
+    # daemonize
+    daemonize(PIPELINE_PID, foreground)
+
+    # initialize logging, shared by all stages
+    logger = setup_logging(argv[0], CONSOLE_LOG_LEVEL, FILE_LOG_LEVEL,
+            LOG_FORMAT, PIPELINE_LOG, DATE_FORMAT)
+    monitor.logger = summer.logger = syncer.logger = logger
+
+    # stages hand over actions in memory; destination queues first, so
+    # that a checkpoint never has hash map ahead of what is queued
+    for config in DESTINATIONS:
+        share_atomic('%s.%s' % (FILES_SYNC_FILE, config['name']))
+    for path in (FILES_SYNC_FILE, FILES_STATUS_FILE, FILES_HASH_FILE):
+        share_atomic(path)
+    atexit.register(checkpoint)
+    signal.signal(signal.SIGTERM, terminate)
+
+    summer.setup()
+    syncer.setup()
+    notifier = monitor.setup()
+    checkpoint()
+
+    # enter loop
+    logger.debug('Pipeline starting... Entering main loop.')
+    last_checkpoint = time.time()
+    while True:
+        pipeline_step(notifier)
+        if time.time() - last_checkpoint >= CHECKPOINT_INTERVAL:
+            checkpoint()
+            last_checkpoint = time.time()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
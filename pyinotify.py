@@ -70,6 +70,7 @@ if sys.version < '2.4':
 # Import directives
 import threading
 import os
+import stat
 import select
 import struct
 import fcntl
@@ -93,6 +94,15 @@ try:
 except ImportError:
     pass  # Will fail on Python 2.4 which has reduce() builtin anyway.
 
+# Only needed by AsyncioNotifier, trollius is asyncio backport for Python 2.
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
 __author__ = "seb@dbzteam.org (Sebastien Martini)"
 
 __version__ = "0.9.0"
@@ -214,6 +224,7 @@ class SysCtlINotify:
         sino = ctypes.c_int * 3
         self._attrname = attrname
         self._attr = sino(5, 20, SysCtlINotify.inotify_attrs[attrname])
+        self._procpath = '/proc/sys/fs/inotify/%s' % attrname
 
     def get_val(self):
         """
@@ -222,30 +233,34 @@ class SysCtlINotify:
         @return: stored value.
         @rtype: int
         """
-        oldv = ctypes.c_int(0)
-        size = ctypes.c_int(ctypes.sizeof(oldv))
-        LIBC.sysctl(self._attr, 3,
-                    ctypes.c_voidp(ctypes.addressof(oldv)),
-                    ctypes.addressof(size),
-                    None, 0)
-        return oldv.value
+        # sysctl(2) is gone from recent kernels, /proc/sys is always there
+        try:
+            file_obj = open(self._procpath)
+            try:
+                return int(file_obj.readline())
+            finally:
+                file_obj.close()
+        except (IOError, ValueError):
+            oldv = ctypes.c_int(0)
+            size = ctypes.c_int(ctypes.sizeof(oldv))
+            LIBC.sysctl(self._attr, 3,
+                        ctypes.c_voidp(ctypes.addressof(oldv)),
+                        ctypes.addressof(size),
+                        None, 0)
+            return oldv.value
 
     def set_val(self, nval):
         """
-        Sets new attribute's value.
+        Sets new attribute's value. Raises IOError if not permitted.
 
         @param nval: replaces current value by nval.
         @type nval: int
         """
-        oldv = ctypes.c_int(0)
-        sizeo = ctypes.c_int(ctypes.sizeof(oldv))
-        newv = ctypes.c_int(nval)
-        sizen = ctypes.c_int(ctypes.sizeof(newv))
-        LIBC.sysctl(self._attr, 3,
-                    ctypes.c_voidp(ctypes.addressof(oldv)),
-                    ctypes.addressof(sizeo),
-                    ctypes.c_voidp(ctypes.addressof(newv)),
-                    ctypes.addressof(sizen))
+        file_obj = open(self._procpath, 'w')
+        try:
+            file_obj.write('%d\n' % nval)
+        finally:
+            file_obj.close()
 
     value = property(get_val, set_val)
 
@@ -394,13 +409,20 @@ ALL_EVENTS = reduce(lambda x, y: x | y, EventsCodes.OP_FLAGS.values())
 EventsCodes.ALL_FLAGS['ALL_EVENTS'] = ALL_EVENTS
 EventsCodes.ALL_VALUES[ALL_EVENTS] = 'ALL_EVENTS'
 
+# Header of struct inotify_event (wd, mask, cookie, len), followed by len
+# bytes of NUL padded name.
+_EVENT_HEADER = struct.Struct('iIII')
+
 
-class _Event:
+class _Event(object):
     """
     Event structure, represent events raised by the system. This
-    is the base class and should be subclassed.
+    is the base class and should be subclassed. Subclasses declare their
+    fields in __slots__ so that no per-instance dictionary is allocated.
 
     """
+    __slots__ = ()
+
     def __init__(self, dict_):
         """
         Attach attributes (contained in dict_) to self.
@@ -411,17 +433,34 @@ class _Event:
         for tpl in dict_.items():
             setattr(self, *tpl)
 
+    def _attrs(self):
+        """
+        @return: Public attributes which are set, with their values.
+        @rtype: dict
+        """
+        attrs = {}
+        for cls in type(self).__mro__:
+            for attr in getattr(cls, '__slots__', ()):
+                if attr.startswith('_') or attr in attrs:
+                    continue
+                try:
+                    attrs[attr] = getattr(self, attr)
+                except AttributeError:
+                    pass
+        for attr, value in getattr(self, '__dict__', {}).items():
+            if not attr.startswith('_'):
+                attrs[attr] = value
+        return attrs
+
     def __repr__(self):
         """
         @return: Generic event string representation.
         @rtype: str
         """
         s = ''
-        for attr, value in sorted(self.__dict__.items(), key=lambda x: x[0]):
-            if attr.startswith('_'):
-                continue
+        for attr, value in sorted(self._attrs().items(), key=lambda x: x[0]):
             if attr == 'mask':
-                value = hex(getattr(self, attr))
+                value = hex(value)
             elif isinstance(value, basestring) and not value:
                 value = "''"
             s += ' %s%s%s' % (Color.field_name(attr),
@@ -440,6 +479,8 @@ class _RawEvent(_Event):
     Raw event, it contains only the informations provided by the system.
     It doesn't infer anything.
     """
+    __slots__ = ('wd', 'mask', 'cookie', 'name', '_str')
+
     def __init__(self, wd, mask, cookie, name):
         """
         @param wd: Watch Descriptor.
@@ -454,12 +495,13 @@ class _RawEvent(_Event):
                      on the watched item itself.
         @type name: string or None
         """
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
         # name: remove trailing '\0'
-        _Event.__init__(self, {'wd': wd,
-                               'mask': mask,
-                               'cookie': cookie,
-                               'name': name.rstrip('\0')})
-        log.debug(repr(self))
+        self.name = name.rstrip('\0')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(repr(self))
         # Use this variable to cache the result of str(self)
         self._str = None
 
@@ -495,25 +537,63 @@ class Event(_Event):
       - cookie (int): Cookie.
       - dir (bool): True if the event was raised against a directory.
 
+    maskname and pathname are computed on first access. Any other
+    attribute can still be attached to an event.
+
     """
+    __slots__ = ('wd', 'mask', 'cookie', 'path', 'name', 'dir',
+                 'src_pathname', 'is_dir', '_maskname', '_pathname',
+                 '__dict__')
+
     def __init__(self, raw):
         """
         Concretely, this is the raw event plus inferred infos.
         """
         _Event.__init__(self, raw)
-        self.maskname = EventsCodes.maskname(self.mask)
-        if COMPATIBILITY_MODE:
-            self.event_name = self.maskname
-        try:
-            if self.name:
-                self.pathname = os.path.abspath(os.path.join(self.path,
-                                                             self.name))
+        self._maskname = None
+        self._pathname = None
+
+    def _get_maskname(self):
+        if self._maskname is None:
+            self._maskname = EventsCodes.maskname(self.mask)
+        return self._maskname
+
+    def _set_maskname(self, maskname):
+        self._maskname = maskname
+
+    maskname = property(_get_maskname, _set_maskname)
+
+    def _get_pathname(self):
+        # Raises AttributeError when there is no path, some events are
+        # perfectly valid despite the lack of it.
+        if self._pathname is None:
+            if getattr(self, 'name', None):
+                self._pathname = os.path.abspath(os.path.join(self.path,
+                                                              self.name))
             else:
-                self.pathname = os.path.abspath(self.path)
-        except AttributeError, err:
-            # Usually it is not an error some events are perfectly valids
-            # despite the lack of these attributes.
-            log.debug(err)
+                self._pathname = os.path.abspath(self.path)
+        return self._pathname
+
+    def _set_pathname(self, pathname):
+        self._pathname = pathname
+
+    pathname = property(_get_pathname, _set_pathname)
+
+    def _get_event_name(self):
+        if not COMPATIBILITY_MODE:
+            raise AttributeError('event_name')
+        return self.maskname
+
+    event_name = property(_get_event_name)
+
+    def _attrs(self):
+        attrs = _Event._attrs(self)
+        for attr in ('maskname', 'pathname', 'event_name'):
+            try:
+                attrs[attr] = getattr(self, attr)
+            except AttributeError:
+                pass
+        return attrs
 
 
 class ProcessEventError(PyinotifyError):
@@ -700,18 +780,11 @@ class _SysProcessEvent(_ProcessEvent):
         mv_ = self._mv.get(src_path)
         if mv_:
             dest_path = mv_[0]
-            watch_.path = dest_path
-            # add the separator to the source path to avoid overlapping
-            # path issue when testing with startswith()
-            src_path += os.path.sep
-            src_path_len = len(src_path)
-            # The next loop renames all watches with src_path as base path.
-            # It seems that IN_MOVE_SELF does not provide IN_ISDIR information
-            # therefore the next loop is iterated even if raw_event is a file.
-            for w in self._watch_manager.watches.values():
-                if w.path.startswith(src_path):
-                    # Note that dest_path is a normalized path.
-                    w.path = os.path.join(dest_path, w.path[src_path_len:])
+            # Renames all watches with src_path as base path, walking only
+            # the moved subtree. It seems that IN_MOVE_SELF does not provide
+            # IN_ISDIR information therefore this is done even if raw_event
+            # is a file. Note that dest_path is a normalized path.
+            self._watch_manager.move_path(src_path, dest_path)
         else:
             log.error("The pathname '%s' of this watch %s has probably changed "
                       "and couldn't be updated, so it cannot be trusted "
@@ -722,7 +795,9 @@ class _SysProcessEvent(_ProcessEvent):
                       os.path.normpath(os.path.join(watch_.path,
                                                     os.path.pardir)))
             if not watch_.path.endswith('-unknown-path'):
-                watch_.path += '-unknown-path'
+                self._watch_manager.move_path(watch_.path,
+                                              watch_.path + '-unknown-path',
+                                              rec=False)
         return self.process_default(raw_event)
 
     def process_IN_Q_OVERFLOW(self, raw_event):
@@ -1058,7 +1133,8 @@ class Notifier:
         self._timeout = timeout
         # Coalesce events option
         self._coalesce = False
-        # set of str(raw_event), only used when coalesce option is True
+        # set of (wd, mask, cookie, name) tuples, only used when coalesce
+        # option is True
         self._eventset = set()
 
     def append_event(self, event):
@@ -1144,25 +1220,40 @@ class Notifier:
         except Exception, msg:
             raise NotifierError(msg)
         log.debug('Event queue size: %d', queue_size)
+        self._parse_events(r)
+
+    def _parse_events(self, buf):
+        """
+        Parse a batch of raw inotify events and enqueue them. Headers are
+        unpacked in place with a precompiled struct, duplicates (when
+        coalescing) are dropped on (wd, mask, cookie, name) before any
+        _RawEvent is built, and names are stripped of their NUL padding
+        only for enqueued events.
+
+        @param buf: Content read from inotify file descriptor.
+        @type buf: str
+        """
+        unpack_from = _EVENT_HEADER.unpack_from
+        s_size = _EVENT_HEADER.size
+        eventq = self._eventq
+        eventset = self._eventset
+        coalesce = self._coalesce
+        buf_size = len(buf)
         rsum = 0  # counter
-        while rsum < queue_size:
-            s_size = 16
+        while rsum < buf_size:
             # Retrieve wd, mask, cookie and fname_len
-            wd, mask, cookie, fname_len = struct.unpack('iIII',
-                                                        r[rsum:rsum+s_size])
-            # Retrieve name
-            fname, = struct.unpack('%ds' % fname_len,
-                                   r[rsum + s_size:rsum + s_size + fname_len])
-            rawevent = _RawEvent(wd, mask, cookie, fname)
-            if self._coalesce:
+            wd, mask, cookie, fname_len = unpack_from(buf, rsum)
+            # Retrieve (still padded) name
+            start = rsum + s_size
+            fname = buf[start:start + fname_len]
+            rsum = start + fname_len
+            if coalesce:
                 # Only enqueue new (unique) events.
-                raweventstr = str(rawevent)
-                if raweventstr not in self._eventset:
-                    self._eventset.add(raweventstr)
-                    self._eventq.append(rawevent)
-            else:
-                self._eventq.append(rawevent)
-            rsum += s_size + fname_len
+                key = (wd, mask, cookie, fname)
+                if key in eventset:
+                    continue
+                eventset.add(key)
+            eventq.append(_RawEvent(wd, mask, cookie, fname))
 
     def process_events(self):
         """
@@ -1444,11 +1535,265 @@ class AsyncNotifier(asyncore.file_dispatcher, Notifier):
         self.process_events()
 
 
-class Watch:
+class AsyncioNotifier(Notifier):
+    """
+    Notifier for asyncio event loops (trollius under Python 2), reading
+    inotify's file descriptor from a loop.add_reader() callback. Unless a
+    default_proc_fun is given, processed events are handed over to
+    coroutines in batches, one batch per read, through get_batch(). When
+    max_batches batches are waiting for consumers, reading is paused and
+    events are left in the kernel queue until consumers catch up.
+
+    Requires asyncio, under Python 2 the trollius backport has to be
+    installed (pip install trollius), otherwise instantiation raises
+    NotifierError.
+
+    """
+    def __init__(self, watch_manager, loop, callback=None,
+                 default_proc_fun=None, read_freq=0, threshold=0,
+                 timeout=None, max_batches=16):
+        """
+        See Notifier class for the meaning of watch_manager,
+        default_proc_fun, threshold and timeout parameters, read_freq is
+        ignored as the loop decides when to read.
+
+        @param loop: asyncio event loop.
+        @type loop: event loop instance
+        @param callback: Functor called with the notifier after each read.
+        @type callback: callable object or function
+        @param max_batches: Batches waiting for consumers before reading
+                            is paused.
+        @type max_batches: int
+        """
+        if asyncio is None:
+            raise NotifierError('AsyncioNotifier requires asyncio, install '
+                                'trollius under Python 2')
+        self._batching = default_proc_fun is None
+        if self._batching:
+            default_proc_fun = self._collect
+        Notifier.__init__(self, watch_manager, default_proc_fun, read_freq,
+                          threshold, timeout)
+        self._loop = loop
+        self._callback = callback
+        self._max_batches = max_batches
+        self._batch = []
+        self._batches = deque()
+        self._waiters = deque()
+        self._reading = False
+        self.resume_reading()
+
+    def _collect(self, event):
+        """
+        Default processing method when batching, collects events of the
+        current read.
+        """
+        self._batch.append(event)
+
+    def _create_future(self):
+        """
+        @return: New future attached to the loop.
+        @rtype: Future
+        """
+        if hasattr(self._loop, 'create_future'):
+            return self._loop.create_future()
+        return asyncio.Future(loop=self._loop)
+
+    def handle_read(self):
+        """
+        Called by the loop when inotify's file descriptor is readable,
+        reads and processes events and hands over their batch.
+        """
+        self.read_events()
+        self.process_events()
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self._deliver(batch)
+        if self._callback is not None:
+            self._callback(self)
+
+    def _deliver(self, batch):
+        """
+        Hand over batch to the first waiting consumer or queue it, pausing
+        reading when too many are queued.
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            # consumer might have been cancelled meanwhile
+            if not waiter.done():
+                waiter.set_result(batch)
+                return
+        self._batches.append(batch)
+        if len(self._batches) >= self._max_batches:
+            log.debug('%d event batches pending, pausing reading',
+                      len(self._batches))
+            self.pause_reading()
+
+    def get_batch(self):
+        """
+        Get next batch of events, to be awaited (yielded from) in a
+        coroutine. Reading is resumed once consumers have caught up with
+        half of the pending batches.
+
+        @return: Future resolved with list of Event instances.
+        @rtype: Future
+        """
+        waiter = self._create_future()
+        if self._batches:
+            waiter.set_result(self._batches.popleft())
+            if len(self._batches) <= self._max_batches // 2:
+                self.resume_reading()
+        else:
+            self._waiters.append(waiter)
+        return waiter
+
+    def pause_reading(self):
+        """
+        Stop reading inotify's file descriptor.
+        """
+        if self._reading:
+            self._loop.remove_reader(self._fd)
+            self._reading = False
+
+    def resume_reading(self):
+        """
+        Start reading inotify's file descriptor again.
+        """
+        if not self._reading:
+            self._loop.add_reader(self._fd, self.handle_read)
+            self._reading = True
+
+    def stop(self):
+        """
+        Stop reading and close inotify's instance.
+        """
+        self.pause_reading()
+        Notifier.stop(self)
+
+
+class _PathIndex(object):
+    """
+    Trie of watched paths, one node per path component, each node holding
+    the wd of the watch on that path (if any). Lookup of a path costs its
+    depth while walking, moving or pruning a subtree costs the size of
+    that subtree, whatever the total number of watches.
+
+    """
+    __slots__ = ('_root',)
+
+    # key under which a node stores its wd, never a path component
+    _WD = None
+
+    def __init__(self):
+        self._root = {}
+
+    def _split(self, path):
+        """
+        @return: Components of normalized path, '' first for absolute paths.
+        @rtype: list of str
+        """
+        return path.rstrip(os.sep).split(os.sep)
+
+    def _lookup(self, path):
+        """
+        @return: Stack of (node, component) pairs from root to path's node
+                 or None if there is no such node.
+        @rtype: list
+        """
+        stack = []
+        node = self._root
+        for comp in self._split(path):
+            stack.append((node, comp))
+            node = node.get(comp)
+            if node is None:
+                return None
+        stack.append((node, None))
+        return stack
+
+    def _prune(self, stack):
+        """
+        Remove empty nodes bottom-up along a lookup stack.
+        """
+        for i in xrange(len(stack) - 1, 0, -1):
+            if stack[i][0]:
+                break
+            parent, comp = stack[i - 1]
+            del parent[comp]
+
+    def get(self, path):
+        """
+        @return: wd of watch on path or None.
+        @rtype: int or None
+        """
+        node = self._root
+        for comp in self._split(path):
+            node = node.get(comp)
+            if node is None:
+                return None
+        return node.get(self._WD)
+
+    def add(self, path, wd):
+        """
+        Index watch wd on path.
+        """
+        node = self._root
+        for comp in self._split(path):
+            node = node.setdefault(comp, {})
+        node[self._WD] = wd
+
+    def remove(self, path, wd):
+        """
+        Drop watch wd on path from the index if it is still there.
+        """
+        stack = self._lookup(path)
+        if stack is None or stack[-1][0].get(self._WD) != wd:
+            return
+        del stack[-1][0][self._WD]
+        self._prune(stack)
+
+    def walk(self, path):
+        """
+        @return: wds of watches on path and everything below it.
+        @rtype: generator of int
+        """
+        stack = self._lookup(path)
+        if stack is None:
+            return
+        nodes = [stack[-1][0]]
+        while nodes:
+            node = nodes.pop()
+            for comp, child in node.iteritems():
+                if comp is self._WD:
+                    yield child
+                else:
+                    nodes.append(child)
+
+    def move(self, src, dst):
+        """
+        Move subtree of src (node and everything below) under dst,
+        replacing whatever was indexed there.
+        """
+        stack = self._lookup(src)
+        if stack is None:
+            return
+        node = stack[-1][0]
+        parent, comp = stack[-2]
+        del parent[comp]
+        self._prune(stack[:-1])
+        target = self._root
+        comps = self._split(dst)
+        for comp in comps[:-1]:
+            target = target.setdefault(comp, {})
+        target[comps[-1]] = node
+
+
+class Watch(object):
     """
     Represent a watch, i.e. a file or directory being watched.
 
     """
+    __slots__ = ('wd', 'path', 'mask', 'proc_fun', 'auto_add',
+                 'exclude_filter', 'dir')
+
     def __init__(self, wd, path, mask, proc_fun, auto_add, exclude_filter):
         """
         Initializations.
@@ -1484,7 +1829,7 @@ class Watch:
         s = ' '.join(['%s%s%s' % (Color.field_name(attr),
                                   Color.punctuation('='),
                                   Color.field_value(getattr(self, attr))) \
-                      for attr in self.__dict__ if not attr.startswith('_')])
+                      for attr in self.__slots__])
 
         s = '%s%s %s %s' % (Color.punctuation('<'),
                             Color.class_name(self.__class__.__name__),
@@ -1591,6 +1936,7 @@ class WatchManager:
         """
         self._exclude_filter = exclude_filter
         self._wmd = {}  # watch dict key: watch descriptor, value: watch
+        self._paths = _PathIndex()  # watched paths, kept in sync with _wmd
         self._fd = LIBC.inotify_init() # inotify's init, file descriptor
         if self._fd < 0:
             err = 'Cannot initialize new instance of inotify%s' % STRERRNO()
@@ -1622,9 +1968,38 @@ class WatchManager:
         @type wd: int
         """
         try:
-            del self._wmd[wd]
+            watch_ = self._wmd.pop(wd)
         except KeyError, err:
             log.error(str(err))
+            return
+        self._paths.remove(watch_.path, wd)
+
+    def move_path(self, src_path, dst_path, rec=True):
+        """
+        Change path of the watch on src_path and, if rec is True, of all
+        watches below it, keeping the path index in sync. Costs the size
+        of the moved subtree.
+
+        @param src_path: Current (normalized) path.
+        @type src_path: str
+        @param dst_path: New (normalized) path.
+        @type dst_path: str
+        @param rec: Also move watches below src_path.
+        @type rec: bool
+        """
+        if not rec:
+            wd = self._paths.get(src_path)
+            if wd is not None:
+                self._paths.remove(src_path, wd)
+                self._paths.add(dst_path, wd)
+                self._wmd[wd].path = dst_path
+            return
+
+        src_len = len(src_path)
+        for wd in list(self._paths.walk(src_path)):
+            watch_ = self._wmd[wd]
+            watch_.path = dst_path + watch_.path[src_len:]
+        self._paths.move(src_path, dst_path)
 
     @property
     def watches(self):
@@ -1663,6 +2038,7 @@ class WatchManager:
         watch_ = Watch(wd=wd_, path=byte_path, mask=mask, proc_fun=proc_fun,
                        auto_add=auto_add, exclude_filter=exclude_filter)
         self._wmd[wd_] = watch_
+        self._paths.add(byte_path, wd_)
         log.debug('New %s', watch_)
         return wd_
 
@@ -1731,30 +2107,72 @@ class WatchManager:
             # unix pathname pattern expansion
             for apath in self.__glob(npath, do_glob):
                 # recursively list subdirs according to rec param
-                for rpath in self.__walk_rec(apath, rec):
-                    if self.get_wd(rpath) is not None:
-                        # We decide to ignore paths already inserted into
-                        # the watch manager. Need to be removed with rm_watch()
-                        # first. Or simply call update_watch() to update it.
-                        continue
-                    if not exclude_filter(rpath):
-                        wd = ret_[rpath] = self.__add_watch(rpath, mask,
-                                                            proc_fun,
-                                                            auto_add,
-                                                            exclude_filter)
-                        if wd < 0:
-                            err = 'add_watch: cannot watch %s WD=%d%s'
-                            err = err % (rpath, wd, STRERRNO())
-                            if quiet:
-                                log.error(err)
-                            else:
-                                raise WatchManagerError(err, ret_)
-                    else:
-                        # Let's say -2 means 'explicitely excluded
-                        # from watching'.
-                        ret_[rpath] = -2
+                for rpath in self.__walk_rec(apath, rec, exclude_filter):
+                    self.__add_watch_ret(rpath, mask, proc_fun, auto_add,
+                                         exclude_filter, quiet, ret_)
         return ret_
 
+    def add_watch_progressive(self, path, mask, proc_fun=None,
+                              auto_add=False, quiet=True,
+                              exclude_filter=None, batch=1024):
+        """
+        Recursively add watches on path and its subdirectories like
+        add_watch(rec=True) does, but register at most |batch| directories
+        per step. This is a generator, every next() call registers one
+        batch and returns its {path: wd} dict, so that events from already
+        watched directories can be processed in between. Directories are
+        listed only after they are watched, so subdirectories created
+        meanwhile either show up in the listing or generate an event.
+        Files written before their directory got watched are not reported,
+        callers should do a catch-up scan once registration is over.
+
+        @param path: Path to watch.
+        @type path: str
+        @param batch: Directories registered per step.
+        @type batch: int
+        @return: Generator of dicts of paths associated to watch
+                 descriptors, see add_watch().
+        @rtype: generator of dict of {str: int}
+        """
+        if exclude_filter is None:
+            exclude_filter = self._exclude_filter
+
+        ret_ = {}
+        for rpath in self.__walk_rec(path, True, exclude_filter):
+            self.__add_watch_ret(rpath, mask, proc_fun, auto_add,
+                                 exclude_filter, quiet, ret_)
+            if len(ret_) >= batch:
+                yield ret_
+                ret_ = {}
+        if ret_:
+            yield ret_
+
+    def __add_watch_ret(self, rpath, mask, proc_fun, auto_add,
+                        exclude_filter, quiet, ret_):
+        """
+        Add watch on a single path unless it is already watched, recording
+        its wd into ret_ dict (see add_watch()).
+        """
+        if self.get_wd(rpath) is not None:
+            # We decide to ignore paths already inserted into
+            # the watch manager. Need to be removed with rm_watch()
+            # first. Or simply call update_watch() to update it.
+            return
+        if not exclude_filter(rpath):
+            wd = ret_[rpath] = self.__add_watch(rpath, mask, proc_fun,
+                                                auto_add, exclude_filter)
+            if wd < 0:
+                err = 'add_watch: cannot watch %s WD=%d%s'
+                err = err % (rpath, wd, STRERRNO())
+                if quiet:
+                    log.error(err)
+                else:
+                    raise WatchManagerError(err, ret_)
+        else:
+            # Let's say -2 means 'explicitely excluded
+            # from watching'.
+            ret_[rpath] = -2
+
     def __get_sub_rec(self, lpath):
         """
         Get every wd from self._wmd if its path is under the path of
@@ -1778,17 +2196,10 @@ class WatchManager:
             if not os.path.isdir(root):
                 continue
 
-            # normalization
-            root = os.path.normpath(root)
-            # recursion
-            lend = len(root)
-            for iwd in self._wmd.items():
-                cur = iwd[1].path
-                pref = os.path.commonprefix([root, cur])
-                if root == os.sep or (len(pref) == lend and \
-                                      len(cur) > lend and \
-                                      cur[lend] == os.sep):
-                    yield iwd[1].wd
+            # recursion, only through the subtree of root
+            for wd in self._paths.walk(os.path.normpath(root)):
+                if wd != d:
+                    yield wd
 
     def update_watch(self, wd, mask=None, proc_fun=None, rec=False,
                      auto_add=False, quiet=True):
@@ -1876,19 +2287,15 @@ class WatchManager:
 
     def get_wd(self, path):
         """
-        Returns the watch descriptor associated to path. This method
-        presents a prohibitive cost, always prefer to keep the WD
-        returned by add_watch(). If the path is unknown it returns None.
+        Returns the watch descriptor associated to path, looked up in the
+        path index. If the path is unknown it returns None.
 
         @param path: Path.
         @type path: str
         @return: WD or None.
         @rtype: int or None
         """
-        path = self.__format_path(path)
-        for iwd in self._wmd.items():
-            if iwd[1].path == path:
-                return iwd[0]
+        return self._paths.get(self.__format_path(path))
 
     def get_path(self, wd):
         """
@@ -1903,23 +2310,68 @@ class WatchManager:
         if watch_ is not None:
             return watch_.path
 
-    def __walk_rec(self, top, rec):
+    def get_sub_wds(self, path):
+        """
+        Returns the watch descriptors of path and of every path below it,
+        walked in the path index, whether they still exist on disk or not.
+        Costs the size of the subtree.
+
+        @param path: Path.
+        @type path: str
+        @return: List of WDs.
+        @rtype: list of int
+        """
+        return list(self._paths.walk(self.__format_path(path)))
+
+    def __walk_rec(self, top, rec, exclude_filter=None):
         """
         Yields each subdirectories of top, doesn't follow symlinks.
-        If rec is false, only yield top.
+        If rec is false, only yield top. Subdirectories excluded by
+        exclude_filter are yielded but not descended into.
 
         @param top: root directory.
         @type top: string
         @param rec: recursive flag.
         @type rec: bool
+        @param exclude_filter: predicate, see add_watch().
+        @type exclude_filter: callable object
         @return: path of one subdirectory.
         @rtype: string
         """
         if not rec or os.path.islink(top) or not os.path.isdir(top):
             yield top
-        else:
-            for root, dirs, files in os.walk(top):
-                yield root
+            return
+
+        # each directory is yielded before it is listed, so that a watch
+        # put on it meanwhile catches subdirectories created afterwards
+        stack = [top]
+        while stack:
+            root = stack.pop()
+            yield root
+            if root is not top and exclude_filter is not None and \
+                    exclude_filter(root):
+                continue
+            try:
+                names = os.listdir(root)
+                # link count of a directory is 2 plus number of its
+                # subdirectories on most filesystems (not on btrfs where it
+                # is always 1), stop stat'ing entries once all are found
+                subdirs = os.lstat(root).st_nlink - 2
+            except OSError:
+                continue
+            if subdirs == 0:
+                continue
+            for name in names:
+                child = os.path.join(root, name)
+                try:
+                    mode = os.lstat(child).st_mode
+                except OSError:
+                    continue
+                if stat.S_ISDIR(mode):
+                    stack.append(child)
+                    subdirs -= 1
+                    if subdirs == 0:
+                        break
 
     def rm_watch(self, wd, rec=False, quiet=True):
         """
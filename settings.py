@@ -34,21 +34,43 @@ WATCH_DIR = '/dare/VMwareDataRecovery'
 # remote directory (aka replica directory)
 REMOTE_DIR = '/dare/VMwareDataRecovery'
 
+# all directories to replicate (must not be nested), each one replicated
+# into its own remote directory on every destination; when several roots
+# have work pending, summer and syncer serve them in proportion to their
+# priorities
+WATCH_ROOTS = [
+    {'name': 'dare', 'path': WATCH_DIR, 'remote_dir': REMOTE_DIR,
+        'priority': 1},
+]
+
 # internal status files -- file modification logs, sha1 sums and
 # permissions and finally remote sync queue
 FILES_STATUS_FILE = '/opt/BlackMesa-DR/BlackMesa-DR.status'
 FILES_HASH_FILE = '/opt/BlackMesa-DR/BlackMesa-DR.hash'
 FILES_SYNC_FILE = '/opt/BlackMesa-DR/BlackMesa-DR.sync'
 
+# every change in action map gets a monotonically increasing sequence
+# number; they are handed out in blocks of SEQUENCE_BLOCK and the end of
+# the last reserved block is kept in FILES_SEQUENCE_FILE
+FILES_SEQUENCE_FILE = '/opt/BlackMesa-DR/BlackMesa-DR.seq'
+SEQUENCE_BLOCK = 1000
+
 # logfiles for all three components
 MONITOR_LOG = '/opt/BlackMesa-DR/BlackMesa-DR-monitor.log'
 SUMMER_LOG = '/opt/BlackMesa-DR/BlackMesa-DR-summer.log'
 SYNCER_LOG = '/opt/BlackMesa-DR/BlackMesa-DR-syncer.log'
+PIPELINE_LOG = '/opt/BlackMesa-DR/BlackMesa-DR-pipeline.log'
 
 # pid files for all three components
 MONITOR_PID = '/opt/BlackMesa-DR/BlackMesa-DR-monitor.pid'
 SUMMER_PID = '/opt/BlackMesa-DR/BlackMesa-DR-summer.pid'
 SYNCER_PID = '/opt/BlackMesa-DR/BlackMesa-DR-syncer.pid'
+PIPELINE_PID = '/opt/BlackMesa-DR/BlackMesa-DR-pipeline.pid'
+
+# single process mode (pipeline.py running all three components): status
+# files are kept in memory and written every CHECKPOINT_INTERVAL seconds
+# (and on exit) for crash recovery
+CHECKPOINT_INTERVAL = 30
 
 # console log level for all three services (by default disabled)
 CONSOLE_LOG_LEVEL = None
@@ -65,13 +87,148 @@ DATE_FORMAT = '%a %b %d %H:%M:%S %Z %Y'
 # polling time for summer and syncer
 SLEEP_TIME = 5
 
-# remote server timeout sleep time
+# after inotify queue overflow monitor rescans watched tree comparing
+# stat signatures against hash map, at most once per RESCAN_INTERVAL
+# seconds; kernel event queue is raised up to INOTIFY_MAX_QUEUED_EVENTS
+# where permitted
+RESCAN_INTERVAL = 60
+INOTIFY_MAX_QUEUED_EVENTS = 1048576
+
+# directories monitor watches per step at startup, events from directories
+# already watched are processed between steps
+REGISTER_BATCH = 1024
+
+# fnmatch(3) patterns of paths not to replicate at all, matched against
+# path relative to its watch root: patterns without slash match any path
+# component (file or directory name), those with slash match from watch
+# root on, and a match covers everything below it too; if INCLUDE_PATTERNS
+# is not empty only files matching one of them are replicated
+EXCLUDE_PATTERNS = ['*.tmp', '*.lock', '*.partial', '.rsync-partial',
+        '*.swp']
+INCLUDE_PATTERNS = []
+
+# inotify watches monitor uses at most, by default max_user_watches less
+# WATCH_RESERVE left for other processes; directories over budget are
+# stat polled at POLL_RATE directories per second, and once they show
+# activity swapped with watched directories idle for WATCH_COLD_AGE seconds
+MAX_WATCHES = None
+WATCH_RESERVE = 8192
+POLL_RATE = 200
+WATCH_COLD_AGE = 3600
+
+# remote server timeout sleep time (backoff after per-file errors)
 TIMEOUT_SLEEP_TIME = 300
 
-# remote/local commands syntax (usually not required to change)
-SYNC_COMMAND = 'rsync --timeout=600 --delete-after --password-file=/opt/BlackMesa-DR/password-file -a %s dare@10.4.224.41::dare' + REMOTE_DIR + '/%s'
-REMOVE_COMMAND = 'ssh root@10.4.224.41 rm -f ' + REMOTE_DIR + '/%s'
-REMOVE_DIR_COMMAND = 'ssh root@10.4.224.41 rm -rf ' + REMOTE_DIR + '/%s'
-MAKE_DIR_COMMAND = 'ssh root@10.4.224.41 mkdir -m %s -p ' + REMOTE_DIR + '/%s'
-PRE_COMMAND = 'ssh root@10.4.224.41 mkdir -p ' + REMOTE_DIR + '/%s'
-CHMOD_COMMAND = 'ssh root@10.4.224.41 chmod %s ' + REMOTE_DIR + '/%s'
+# remote destination health: after this many consecutive connection-level
+# failures stop dispatching to destination and only probe it every
+# DEST_PROBE_INTERVAL seconds until it is reachable again
+DEST_FAILURE_THRESHOLD = 3
+DEST_PROBE_INTERVAL = 60
+
+# action failing with per-file (non-connection) error is kept and retried
+# after TIMEOUT_SLEEP_TIME seconds, doubled with every further failure up
+# to SYNC_RETRY_MAX_INTERVAL seconds; only vanished files are given up on
+SYNC_RETRY_MAX_INTERVAL = 3600
+
+# backpressure between stages: destination sync queue keeps at most
+# SYNC_QUEUE_HIGH actions in memory (and in its file), the rest goes to
+# append-only spill segments (FILES_SYNC_FILE.<name>.spill.<n>) and is read
+# back once queue drains below SYNC_QUEUE_LOW; syncer stops taking actions
+# from summer while every destination has SYNC_QUEUE_HIGH actions pending,
+# and summer stops checksumming while its own sync queue is that long, both
+# until backlog drains below SYNC_QUEUE_LOW
+SYNC_QUEUE_HIGH = 10000
+SYNC_QUEUE_LOW = 5000
+
+# replica destinations, every one of them with its own sync queue (kept in
+# FILES_SYNC_FILE.<name>), number of concurrent transfers and bandwidth
+# limit in KBps shared by its transfers (0 means unlimited); all actions
+# from summer are replicated to every destination; file contents are sent
+# with rsync(1) unless 'transfer' is 'native' (block-level transfer to
+# receiver agent started with RECEIVER_COMMAND)
+DESTINATIONS = [
+    {'name': 'primary', 'host': '10.4.224.41', 'module': 'dare',
+        'concurrency': 2, 'bwlimit': 0, 'transfer': 'rsync'},
+]
+
+# native transfer: block size (summer keeps per-block checksums of every
+# file in FILES_BLOCKS_DIR so only changed blocks are sent) and timeout in
+# seconds when waiting for the receiver to send or take data
+TRANSFER_BLOCK_SIZE = 1048576
+FILES_BLOCKS_DIR = '/opt/BlackMesa-DR/blocks'
+TRANSFER_TIMEOUT = 600
+
+# manifest of every destination and watch root {relpath: (size, mtime,
+# permissions, digest)} is cached in FILES_MANIFEST_FILE.<name>.<root> and
+# updated with what syncer itself changes remotely; when there is no cached
+# manifest (or it has been removed to force a refresh) it is fetched with
+# MANIFEST_COMMAND, and syncs of files which are remotely identical are
+# skipped; syncs of a watch root wait while its manifest is being fetched (at
+# most MANIFEST_TIMEOUT seconds), and failed fetch is retried after
+# MANIFEST_RETRY_INTERVAL seconds (everything is synced meanwhile)
+FILES_MANIFEST_FILE = '/opt/BlackMesa-DR/BlackMesa-DR.manifest'
+MANIFEST_TIMEOUT = 3600
+MANIFEST_RETRY_INTERVAL = 600
+
+# native transfers of files at least this big (in bytes) are staged on the
+# receiver and resumed from where they stopped after a timeout or dropped
+# link, and renamed into place only when complete
+TRANSFER_RESUME_MIN_SIZE = 67108864
+
+# global bandwidth budget in KBps shared by all concurrent transfers to all
+# destinations (0 means unlimited); BANDWIDTH_WINDOWS override it for given
+# days of week (0 is Monday) and hours [start, end); every rsync gets an
+# even share of what is left of the budget as --bwlimit for its whole run,
+# native transfers split the rest evenly and follow changes of budget and
+# of the number of transfers while running, and metadata operations are
+# not limited at all
+BANDWIDTH_LIMIT = 0
+BANDWIDTH_WINDOWS = [
+    # business hours
+    ((0, 1, 2, 3, 4), 8, 18, 2048),
+]
+
+# runtime override: if this file exists, it contains global bandwidth
+# budget in KBps which takes precedence over settings above
+BANDWIDTH_FILE = '/opt/BlackMesa-DR/BlackMesa-DR.bwlimit'
+
+# minimal bandwidth share in KBps a transfer has to get to be started
+BANDWIDTH_MIN = 64
+
+# files at least this big (in bytes) having the same content as an already
+# replicated file are copied on the remote side instead of being sent
+DEDUP_MIN_SIZE = 1048576
+
+# summer lanes: pending actions are split into metadata-only ones and
+# checksumming of small (below SUMMER_SMALL_SIZE bytes) and large files;
+# lanes share checksumming time in proportion to SUMMER_LANE_SHARES and
+# within a lane oldest changes go first, but whatever has waited for
+# SUMMER_MAX_WAIT seconds is taken before everything else; depth and wait
+# times of every lane are logged every SUMMER_REPORT_INTERVAL seconds
+SUMMER_SMALL_SIZE = 1048576
+SUMMER_LANE_SHARES = {'metadata': 4, 'small': 4, 'large': 1}
+SUMMER_MAX_WAIT = 600
+SUMMER_REPORT_INTERVAL = 300
+
+# how many pending actions of a single destination queue to look at when
+# searching for actions that can run concurrently
+DISPATCH_WINDOW = 1000
+
+# remote/local commands syntax (usually not required to change); besides
+# destination keys, available are %(path)s for local path, %(root)s and
+# %(remote_dir)s for name and remote directory of its watch root, %(relpath)s
+# for path relative to watch root, %(srcrelpath)s for relative path of moved or
+# copied file and %(perm)s for octal permissions; COPY_COMMAND has to print
+# sha1sum(1) of the copy for verification; SYNC_COMMAND keeps interrupted
+# transfers in partial directory so they can be resumed
+SYNC_COMMAND = 'rsync --timeout=600 --contimeout=60 --bwlimit=%(bwlimit)d --sparse --partial-dir=.rsync-partial --delete-after --password-file=/opt/BlackMesa-DR/password-file -a %(path)s dare@%(host)s::%(module)s%(remote_dir)s/%(relpath)s'
+REMOVE_COMMAND = 'ssh -o ConnectTimeout=60 root@%(host)s rm -f %(remote_dir)s/%(relpath)s'
+REMOVE_DIR_COMMAND = 'ssh -o ConnectTimeout=60 root@%(host)s rm -rf %(remote_dir)s/%(relpath)s'
+MAKE_DIR_COMMAND = 'ssh -o ConnectTimeout=60 root@%(host)s mkdir -m %(perm)s -p %(remote_dir)s/%(relpath)s'
+PRE_COMMAND = 'ssh -o ConnectTimeout=60 root@%(host)s mkdir -p %(remote_dir)s/%(relpath)s'
+MOVE_COMMAND = 'ssh -o ConnectTimeout=60 root@%(host)s mv -fT %(remote_dir)s/%(srcrelpath)s %(remote_dir)s/%(relpath)s'
+COPY_COMMAND = 'ssh -o ConnectTimeout=60 root@%(host)s "cp -p --reflink=auto %(remote_dir)s/%(srcrelpath)s %(remote_dir)s/%(relpath)s && chmod %(perm)s %(remote_dir)s/%(relpath)s && sha1sum %(remote_dir)s/%(relpath)s"'
+CHMOD_COMMAND = 'ssh -o ConnectTimeout=60 root@%(host)s chmod %(perm)s %(remote_dir)s/%(relpath)s'
+RECEIVER_COMMAND = 'ssh -o ConnectTimeout=60 -o ServerAliveInterval=60 root@%(host)s python /opt/BlackMesa-DR/transfer.py %(remote_dir)s /opt/BlackMesa-DR/receiver.%(root)s'
+MANIFEST_COMMAND = 'ssh -o ConnectTimeout=60 root@%(host)s python /opt/BlackMesa-DR/transfer.py --manifest %(remote_dir)s /opt/BlackMesa-DR/manifest.cache.%(root)s'
+PROBE_COMMAND = 'ssh -o ConnectTimeout=10 -o BatchMode=yes root@%(host)s true'
@@ -28,24 +28,48 @@ import time
 import os
 import stat
 import sys
-import random
 import collections
 
 from common import write_atomic, read_atomic, sha1sum, setup_logging, \
-    parse_argv, daemonize
+    parse_argv, daemonize, write_blocks, move_blocks, stat_signature, \
+    find_root, RootScheduler, changes_since, ActionMap
 from settings import *
 
 
-FilesActionMap = {}
+# actions which need file contents checksummed (attributes change only if
+# contents have moved too), the rest only touch metadata
+DATA_ACTIONS = ('created', 'changed', 'attrib', 'moved_changed')
+FilesActionMap = ActionMap()
+# paths with pending actions per lane and watch root {lane: {root name:
+# {path: time queued}}}, oldest first, kept up to date from action map
+# change feed starting after Cursor sequence number
+FilesPending = {}
+# where pending paths are queued {path: (lane, root name)}
+PendingLanes = {}
+Cursor = 0
 FilesHashMap = {}
+FilesDigestMap = {}
 FilesSyncQueue = collections.deque()
+# block digests are needed only for native transfers
+BlockDigests = [x for x in DESTINATIONS if x.get('transfer') == 'native']
+Scheduler = RootScheduler(WATCH_ROOTS)
+# lanes share checksumming time the way watch roots share turns
+Lanes = RootScheduler([{'name': x, 'priority': y}
+    for x, y in SUMMER_LANE_SHARES.items()])
+# lane statistics since last report {lane: (served, total wait, longest
+# wait)}
+LaneStats = {}
+LastLaneReport = 0
+# checksumming paused by backpressure from syncer
+Paused = False
 logger = None
 foreground = False
 
 
-def check_updated(monitor_action, monitor_timestamp, myfile):
-    """Check if action map has been updated in the meantime. Returns True
-if yes, False otherwise.
+def check_updated(monitor_action, monitor_sequence, myfile):
+    """Check if action map has been updated in the meantime (entry has
+been changed under a newer sequence number). Returns True if yes, False
+otherwise.
     """
     global FilesActionMap
     global logger
@@ -53,63 +77,316 @@ if yes, False otherwise.
     # reread status and check if there are newer changes
     FilesActionMap = read_atomic(FILES_STATUS_FILE)
 
-    _, monitor_timestampnew = FilesActionMap[myfile]
-    if monitor_timestampnew == monitor_timestamp:
+    # entry might have been carried along with a renamed directory
+    if myfile not in FilesActionMap:
+        forget_pending(myfile)
+        return True
+
+    monitor_sequencenew = FilesActionMap[myfile][1]
+    if monitor_sequencenew == monitor_sequence:
         # remove from action map if there are no changes
         del FilesActionMap[myfile]
         write_atomic(FILES_STATUS_FILE, FilesActionMap)
+        forget_pending(myfile)
     else:
         return True
     return False
 
+def lane_of(myfile, entry):
+    """Classify pending action into metadata-only one, checksumming of a
+small file or of a large one. Returns lane name.
+    """
+    monitor_action = entry[0]
+    # rename of never replicated file is handled as created file
+    if monitor_action == 'moved' and entry[2] not in FilesHashMap:
+        monitor_action = 'created'
+    if monitor_action not in DATA_ACTIONS:
+        return 'metadata'
+    try:
+        mystat = os.stat(myfile)
+    except OSError:
+        # gone, quickly dealt with
+        return 'metadata'
+    if monitor_action == 'attrib' and not contents_moved(myfile, mystat):
+        return 'metadata'
+    if mystat[stat.ST_SIZE] < SUMMER_SMALL_SIZE:
+        return 'small'
+    return 'large'
+
+def contents_moved(myfile, mystat):
+    """Check if file might have been written to since it was checksummed,
+i.e. its size or mtime differ from stored stat signature. Returns True if
+yes, False otherwise.
+    """
+    entry = FilesHashMap.get(myfile)
+    # entries without signature predate it
+    if entry is None or len(entry) < 3:
+        return True
+    return stat_signature(mystat)[:2] != entry[2][:2]
+
+def update_pending():
+    """Queue paths changed since last run at the back of their lanes,
+moving cursor along the change feed. Does not return anything.
+    """
+    global Cursor
+
+    now = time.time()
+    for sequence, path, entry in changes_since(FilesActionMap, Cursor):
+        # changed again, requeue (possibly in another lane)
+        forget_pending(path)
+        lane = lane_of(path, entry)
+        root, _ = find_root(path, WATCH_ROOTS)
+        name = root and root['name']
+        FilesPending.setdefault(lane, {}).setdefault(name,
+                collections.OrderedDict())[path] = now
+        PendingLanes[path] = (lane, name)
+        Cursor = sequence
+
+def forget_pending(myfile):
+    """Remove path which has no pending action anymore. Does not return
+anything.
+    """
+    if myfile not in PendingLanes:
+        return
+    lane, name = PendingLanes.pop(myfile)
+    roots = FilesPending[lane]
+    del roots[name][myfile]
+    if not roots[name]:
+        del roots[name]
+        if not roots:
+            del FilesPending[lane]
+
+def pick_pending():
+    """Pick path to handle next: whatever has waited the longest once it
+has waited for SUMMER_MAX_WAIT seconds, otherwise the oldest one of a lane
+and watch root picked in proportion to their shares. Returns (lane, path,
+time queued).
+    """
+    oldest = None
+    for lane, roots in FilesPending.items():
+        for paths in roots.values():
+            path, since = paths.iteritems().next()
+            if oldest is None or since < oldest[2]:
+                oldest = (lane, path, since)
+    if time.time() - oldest[2] >= SUMMER_MAX_WAIT:
+        return oldest
+    lane = Lanes.pick(FilesPending.keys(), 0)
+    paths = FilesPending[lane][Scheduler.pick(FilesPending[lane].keys())]
+    path, since = paths.iteritems().next()
+    return lane, path, since
+
+def report_lanes():
+    """Log depth of every lane and how long its paths have waited, every
+SUMMER_REPORT_INTERVAL seconds. Does not return anything.
+    """
+    global LaneStats
+    global LastLaneReport
+
+    now = time.time()
+    if now - LastLaneReport < SUMMER_REPORT_INTERVAL:
+        return
+    LastLaneReport = now
+    for lane in sorted(SUMMER_LANE_SHARES.keys()):
+        roots = FilesPending.get(lane, {})
+        depth = sum([len(x) for x in roots.values()])
+        served, waited, longest = LaneStats.get(lane, (0, 0.0, 0.0))
+        if not depth and not served:
+            continue
+        oldest = max([now - x.itervalues().next() for x in roots.values()]
+                or [0])
+        logger.info('Lane %s: %d pending (oldest for %.0fs), %d done with '
+                'average wait of %.1fs (longest %.1fs).' % (lane, depth,
+                    oldest, served, served and waited / served or 0,
+                    longest))
+    LaneStats = {}
+
+def index_digest(myfile, mysha1sum):
+    """Add file to reverse (checksum to paths) index. Does not return
+anything.
+    """
+    global FilesDigestMap
+
+    FilesDigestMap.setdefault(mysha1sum, set()).add(myfile)
+
+def find_duplicate(myfile, mysha1sum):
+    """Find another known file with the same content within the same watch
+root (remote copies are done within remote directory). Stale index entries
+are dropped on the way. Returns path or None.
+    """
+    global FilesDigestMap
+
+    myroot, _ = find_root(myfile, WATCH_ROOTS)
+    paths = FilesDigestMap.get(mysha1sum, set())
+    for path in list(paths):
+        if path == myfile or find_root(path, WATCH_ROOTS)[0] is not myroot:
+            continue
+        if path in FilesHashMap and FilesHashMap[path][0] == mysha1sum:
+            return path
+        paths.discard(path)
+    return None
+
+def backlogged():
+    """Check sync queue against watermarks: checksumming is paused once it
+holds SYNC_QUEUE_HIGH actions, until syncer drains it below SYNC_QUEUE_LOW.
+Returns True if paused, False otherwise.
+    """
+    global Paused
+
+    length = len(read_atomic(FILES_SYNC_FILE))
+    if not Paused and length >= SYNC_QUEUE_HIGH:
+        logger.warn('Sync queue holds %d actions. Pausing checksumming.' %
+                length)
+        Paused = True
+    elif Paused and length < SYNC_QUEUE_LOW:
+        logger.warn('Sync queue drained to %d actions. Resuming '
+                'checksumming.' % length)
+        Paused = False
+    return Paused
+
 def decisionlogic():
     """Main decision/summing loop. Returns False if no more actions
 to perform.
     """
     global FilesActionMap
-    global FilesHashMap
-    global FilesSyncQueue
+    global Cursor
     global logger
 
     # reread fresh status on every run
     FilesActionMap = read_atomic(FILES_STATUS_FILE)
+    report_lanes()
 
     # ignore if no actions pending
     if len(FilesActionMap.keys()) == 0:
+        FilesPending.clear()
+        PendingLanes.clear()
+        return False
+
+    # syncer is falling behind, don't checksum far ahead of it
+    if backlogged():
         return False
 
-    # random choice to avoid checksumming the same file over and over if
-    # it changes often
-    myfile = random.choice(FilesActionMap.keys())
-    monitor_action, monitor_timestamp = FilesActionMap[myfile]
+    # pick lane and watch root in proportion to their shares and then the
+    # oldest change; file which changes often keeps going to the back, so
+    # it is not checksummed over and over
+    update_pending()
+    # sequence numbers went back (monitor lost its sequence file), follow
+    # the feed from its start
+    if not FilesPending:
+        Cursor = 0
+        update_pending()
+    lane, myfile, since = pick_pending()
+    # entry has been consumed by a rename meanwhile
+    if myfile not in FilesActionMap:
+        forget_pending(myfile)
+        return True
+
+    served, waited, longest = LaneStats.get(lane, (0, 0.0, 0.0))
+    wait = time.time() - since
+    LaneStats[lane] = (served + 1, waited + wait, max(longest, wait))
+
+    # lanes share checksumming time
+    start = time.time()
+    handle_action(myfile)
+    Lanes.charge(lane, time.time() - start)
+    return True
+
+def handle_action(myfile):
+    """Checksum file (or otherwise handle pending action of path), update
+hash map and queue remote actions. Does not return anything.
+    """
+    global FilesHashMap
+    global FilesDigestMap
+    global FilesSyncQueue
+    global logger
+
+    monitor_action, monitor_sequence = FilesActionMap[myfile][:2]
 
     # by default don't resync nor remote remove files
     sync_action = None
+    move_action = None
     myperm = None
 
+    # renamed file, carry checksum along and move remotely; if source is
+    # unknown it has never been replicated so handle it as created file
+    if monitor_action in ('moved', 'moved_changed'):
+        mysrc = FilesActionMap[myfile][2]
+        if mysrc in FilesHashMap:
+            FilesHashMap[myfile] = FilesHashMap.pop(mysrc)
+            index_digest(myfile, FilesHashMap[myfile][0])
+            if BlockDigests:
+                move_blocks(FILES_BLOCKS_DIR, mysrc, myfile)
+            move_action = (myfile, 'move', mysrc)
+            # changed after rename, recheck checksum and permissions
+            if monitor_action == 'moved_changed':
+                monitor_action = 'changed'
+        else:
+            monitor_action = 'created'
+
+    # renamed directory, carry along checksums of everything below it and
+    # move remotely
+    elif monitor_action in ('moved_dir', 'moved_dir_changed'):
+        mysrc = FilesActionMap[myfile][2]
+        prefix = mysrc + '/'
+        for path in FilesHashMap.keys():
+            if path.startswith(prefix):
+                newpath = myfile + path[len(mysrc):]
+                FilesHashMap[newpath] = FilesHashMap.pop(path)
+                index_digest(newpath, FilesHashMap[newpath][0])
+                if BlockDigests:
+                    move_blocks(FILES_BLOCKS_DIR, path, newpath)
+        move_action = (myfile, 'move_dir', mysrc)
+        # changed after rename, recheck permissions
+        if monitor_action == 'moved_dir_changed':
+            monitor_action = 'attrib_dir'
+
+    # attribute change (chmod, chown or touch) needs only stat, unless
+    # contents have moved as well
+    if monitor_action == 'attrib':
+        try:
+            mystat = os.stat(myfile)
+        except (IOError, OSError):
+            logger.info('Could not get permissions for file %s. Ignoring.'
+                    % myfile)
+            check_updated(None, monitor_sequence, myfile)
+            return
+        if contents_moved(myfile, mystat):
+            monitor_action = 'changed'
+
+    if monitor_action == 'attrib':
+        mysha1sum, mypermold = FilesHashMap[myfile][:2]
+        myperm = oct(stat.S_IMODE(mystat[stat.ST_MODE]))
+        if myperm != mypermold:
+            sync_action = 'change_perm'
+        # ownership and times are not replicated, only remembered so that
+        # rescan does not take them for drift
+        FilesHashMap[myfile] = mysha1sum, myperm, stat_signature(mystat)
+
     # file is freshly created or changed
-    if monitor_action == 'changed' or monitor_action == 'created' or \
-            monitor_action == 'attrib':
-        # calculate checksum
+    elif monitor_action == 'changed' or monitor_action == 'created':
+        # calculate checksum (and block checksums in the same pass)
         try:
-            mysha1sum = sha1sum(myfile)
+            if BlockDigests:
+                mysha1sum, myblocks = sha1sum(myfile, TRANSFER_BLOCK_SIZE)
+            else:
+                mysha1sum = sha1sum(myfile)
         except (IOError, OSError):
             logger.info('Could not checksum file %s. Ignoring.' % myfile)
-            check_updated(None, monitor_timestamp, myfile)
-            return True
+            check_updated(None, monitor_sequence, myfile)
+            return
 
-        # get permissions
+        # get permissions and size
         try:
-            myperm = oct(stat.S_IMODE(os.stat(myfile)[stat.ST_MODE]))
+            mystat = os.stat(myfile)
+            myperm = oct(stat.S_IMODE(mystat[stat.ST_MODE]))
         except (IOError, OSError):
             logger.info('Could not get permissions for file %s. Ignoring.'
                     % myfile)
-            check_updated(None, monitor_timestamp, myfile)
-            return True
+            check_updated(None, monitor_sequence, myfile)
+            return
 
         # already known file
         if myfile in FilesHashMap:
-            mysha1sumold, mypermold = FilesHashMap[myfile]
+            mysha1sumold, mypermold = FilesHashMap[myfile][:2]
             # if checksum is different, resync is mandatory
             if mysha1sumold != mysha1sum:
                 sync_action = 'sync'
@@ -119,12 +396,33 @@ to perform.
         # first time seen file (no checksum and no mode)
         else:
             sync_action = 'sync'
-        FilesHashMap[myfile] = mysha1sum, myperm
+        # stat signature lets monitor find drifted files on rescan
+        FilesHashMap[myfile] = mysha1sum, myperm, stat_signature(mystat)
+        index_digest(myfile, mysha1sum)
+        if BlockDigests:
+            write_blocks(FILES_BLOCKS_DIR, myfile, (mystat[stat.ST_SIZE],
+                int(mystat[stat.ST_MTIME]), TRANSFER_BLOCK_SIZE, mysha1sum,
+                myblocks))
+
+        # same content already known under another path, let syncer copy
+        # it remotely instead of sending it over again
+        if sync_action == 'sync' and mystat[stat.ST_SIZE] >= DEDUP_MIN_SIZE:
+            mysrc = find_duplicate(myfile, mysha1sum)
+            if mysrc:
+                logger.debug('File %s has the same content as %s.' %
+                        (myfile, mysrc))
+                sync_action = 'copy'
+                myperm = (mysrc, mysha1sum, myperm)
+        # syncer checks checksum against remote manifest
+        if sync_action == 'sync':
+            myperm = (None, mysha1sum, myperm)
 
     # deleted file
     elif monitor_action == 'deleted':
         if myfile in FilesHashMap:
             del FilesHashMap[myfile]
+        if BlockDigests:
+            move_blocks(FILES_BLOCKS_DIR, myfile, None)
         sync_action = 'remove'
 
     # created directory
@@ -134,8 +432,8 @@ to perform.
         except (IOError, OSError):
             logger.info('Could not get permissions for directory %s. '
                     'Ignoring.' % myfile)
-            check_updated(None, monitor_timestamp, myfile)
-            return True
+            check_updated(None, monitor_sequence, myfile)
+            return
         sync_action = 'make_dir'
 
     # deleted directory 
@@ -150,8 +448,8 @@ to perform.
         except (IOError, OSError):
             logger.info('Could not get permissions for directory %s. '
                     'Ignoring.' % myfile)
-            check_updated(None, monitor_timestamp, myfile)
-            return True
+            check_updated(None, monitor_sequence, myfile)
+            return
         sync_action = 'change_perm'
 
     # write hash file..
@@ -159,44 +457,37 @@ to perform.
     logger.debug('Hash file status: %s.' % FilesHashMap)
 
     # check if file/directory has been updated in the meantime
-    check_updated(sync_action, monitor_timestamp, myfile)
+    check_updated(sync_action, monitor_sequence, myfile)
 
     # resync or remove remote files
     logger.debug('Pending action %s for file %s.' % (sync_action, myfile))
-    if sync_action:
+    if move_action or sync_action:
         FilesSyncQueue = read_atomic(FILES_SYNC_FILE)
-        FilesSyncQueue.append((myfile, sync_action, myperm))
+        if move_action:
+            FilesSyncQueue.append(move_action)
+        if sync_action:
+            FilesSyncQueue.append((myfile, sync_action, myperm))
         write_atomic(FILES_SYNC_FILE, FilesSyncQueue)
         logger.debug('Pending sync queue: %s.' % FilesSyncQueue)
 
-    return True
-
-def main(argv):
+def setup():
+    """Check watch roots, recreate status files if needed and clean up
+    hash map. Does not return anything.
+    """
     global FilesActionMap
     global FilesHashMap
     global FilesSyncQueue
-    global logger
-    global foreground
-
-    # parse argv
-    parse_argv(argv, globals())
-
-    # daemonize
-    daemonize(SUMMER_PID, foreground)
-
-    # initialize logging
-    logger = setup_logging(argv[0], CONSOLE_LOG_LEVEL, FILE_LOG_LEVEL,
-            LOG_FORMAT, SUMMER_LOG, DATE_FORMAT)
 
     # sanity check
-    if not os.path.isdir(WATCH_DIR):
-        logger.critical('Watched directory %s does not exist. '
-                'Bailing out.' % WATCH_DIR)
-        sys.exit(1)
+    for root in WATCH_ROOTS:
+        if not os.path.isdir(root['path']):
+            logger.critical('Watched directory %s does not exist. '
+                    'Bailing out.' % root['path'])
+            sys.exit(1)
 
     # if FilesActionMap is nonexistant or damaged, truncate it
     try:
-        FilesActionMap = read_atomic(FILES_STATUS_FILE)
+        FilesActionMap = ActionMap(read_atomic(FILES_STATUS_FILE))
     except (IOError, AttributeError, EOFError):
         logger.warn('Unusable action map status file %s. Recreating.' %
                 FILES_STATUS_FILE)
@@ -212,6 +503,14 @@ def main(argv):
         pass
     write_atomic(FILES_HASH_FILE, FilesHashMap)
 
+    # block checksums directory
+    if BlockDigests and not os.path.isdir(FILES_BLOCKS_DIR):
+        os.makedirs(FILES_BLOCKS_DIR)
+
+    # reverse index of checksums, used to find duplicate files
+    for path, entry in FilesHashMap.items():
+        index_digest(path, entry[0])
+
     # if FilesSyncQueue is nonexistant or damaged, truncate it
     try:
         FilesSyncQueue = read_atomic(FILES_SYNC_FILE)
@@ -232,11 +531,29 @@ def main(argv):
             FilesHashMap = read_atomic(FILES_HASH_FILE)
             del FilesHashMap[path]
             write_atomic(FILES_HASH_FILE, FilesHashMap)
+            if BlockDigests:
+                move_blocks(FILES_BLOCKS_DIR, path, None)
             # enqueue to remove remotely
             FilesSyncQueue = read_atomic(FILES_SYNC_FILE)
             FilesSyncQueue.append((path, 'remove', 0))
             write_atomic(FILES_SYNC_FILE, FilesSyncQueue)
 
+def main(argv):
+    global logger
+    global foreground
+
+    # parse argv
+    parse_argv(argv, globals())
+
+    # daemonize
+    daemonize(SUMMER_PID, foreground)
+
+    # initialize logging
+    logger = setup_logging(argv[0], CONSOLE_LOG_LEVEL, FILE_LOG_LEVEL,
+            LOG_FORMAT, SUMMER_LOG, DATE_FORMAT)
+
+    setup()
+
     # start main loop
     logger.debug('Checksumming service starting... Entering wait loop.')
     while True:
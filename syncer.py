@@ -26,132 +26,1159 @@ __version__ = '$Id: syncer.py,v de859cceb463 2010/10/28 09:10:17 dinko $'
 
 import time
 import os
+import stat
 import sys
 import collections
+import multiprocessing
+import cPickle
+import hashlib
 
-from common import write_atomic, read_atomic, run_with_timeout, \
-    setup_logging, parse_argv, daemonize
+from common import write_atomic, read_atomic, trim_atomic, flush_atomic, \
+    sync_atomic, fsync_path, run_with_timeout, setup_logging, parse_argv, \
+    daemonize, ProcessRunner, OUTPUT_LIMIT, find_root, RootScheduler
 from settings import *
+import transfer
 
 
-FilesSyncQueue = collections.deque()
+# rsync(1) and ssh(1) exit codes which mean that remote destination is
+# unreachable, as opposed to per-file errors: 5 (error starting
+# client-server protocol), 10 (error in socket I/O), 12 (error in rsync
+# protocol data stream), 30 (timeout in data send/receive), 35 (timeout
+# waiting for daemon connection) and 255 (ssh connection failure); -9
+# (killed after local timeout) is a per-file error, as slow transfer of a
+# big file says nothing about destination
+CONNECTION_ERRORS = (5, 10, 12, 30, 35, 255)
+# rsync(1) exit code for vanished source files, no point in retrying
+VANISHED_ERRORS = (24,)
+
+Destinations = []
+Bandwidth = None
+Runner = None
+# summer sync queue held back by backpressure from destinations
+Throttled = False
 logger = None
 foreground = False
 
 
-def check_updated(poporig):
-    """Check if sync queue has been updated in meantime. Returns True if
-yes, False otherwise.
+class CommandsResult(object):
+    """List of (command, timeout) executed one after another by Runner,
+    stopping on first error. Behaves like AsyncResult of worker pool.
     """
-    global FilesSyncQueue
-    global logger
+    def __init__(self, commands, limit=OUTPUT_LIMIT):
+        self.commands = list(commands)
+        self.limit = limit
+        self.retval = (0, '', '')
+        self.process = None
+        self.next()
+
+    def next(self):
+        """Start next command. Does not return anything.
+        """
+        command, timeout = self.commands.pop(0)
+        self.process = Runner.spawn(command, timeout, shell=True,
+                limit=self.limit)
+
+    def ready(self):
+        """Check if all commands have finished (or one of them failed),
+        starting the next one if needed. Returns True if yes, False
+        otherwise.
+        """
+        while self.process is not None and \
+                self.process.returncode is not None:
+            self.retval = self.process.result()
+            self.process = None
+            if self.retval[0] == 0 and self.commands:
+                self.next()
+        return self.process is None
+
+    def get(self):
+        """Returns return code, stdout and stderr of the last executed
+        command.
+        """
+        return self.retval
+
+
+class DestinationHealth(object):
+    """Remote destination health tracking. After DEST_FAILURE_THRESHOLD
+    consecutive connection failures destination is considered down and
+    nothing is dispatched to it; instead it is cheaply probed every
+    DEST_PROBE_INTERVAL seconds until it becomes reachable again. Probe
+    runs in Runner like any other command, so it never blocks the loop.
+    """
+    def __init__(self, name, probe_command):
+        self.name = name
+        self.probe_command = probe_command
+        self.failures = 0
+        self.down_since = None
+        self.last_probe = 0
+        self.probe = None
+
+    def probing(self):
+        """Returns True if probe is running, False otherwise.
+        """
+        return self.probe is not None
 
-    FilesSyncQueue = read_atomic(FILES_SYNC_FILE)
-    popnew = FilesSyncQueue.popleft()
-    if poporig == popnew:
-        write_atomic(FILES_SYNC_FILE, FilesSyncQueue)
-    else:
-        logger.warn('Oops, left side of file sync queue %s has changed. '
-                'This should never happen.' % FilesSyncQueue)
+    def is_up(self):
+        """Check if destination is usable, starting a probe if it is down
+        and probe interval has passed, and checking its result once it has
+        finished. Returns True if up, False otherwise.
+        """
+        if self.down_since is None:
+            return True
+        if self.probe is None:
+            if time.time() - self.last_probe < DEST_PROBE_INTERVAL:
+                return False
+            self.last_probe = time.time()
+            logger.debug('Executing probe_command: %s.' % self.probe_command)
+            self.probe = CommandsResult([(self.probe_command,
+                DEST_PROBE_INTERVAL)])
+            return False
+        if not self.probe.ready():
+            return False
+
+        retval = self.probe.get()
+        self.probe = None
+        if retval[0] != 0:
+            logger.info('Destination %s still unreachable (error %d).' %
+                    (self.name, retval[0]))
+            return False
+
+        logger.warn('Destination %s is reachable again after %d seconds. '
+                'Resuming.' % (self.name, time.time() - self.down_since))
+        self.record_success()
         return True
-    return False
 
-def decisionlogic():
-    """Main decision/syncing loop. Returns False if no more actions to
-perform.
+    def record_success(self):
+        """Reset failure counter. Does not return anything.
+        """
+        self.failures = 0
+        self.down_since = None
+        self.probe = None
+
+    def record_failure(self):
+        """Count connection-level failure and mark destination as down if
+        threshold has been reached. Does not return anything.
+        """
+        self.failures += 1
+        if self.down_since is None and \
+                self.failures >= DEST_FAILURE_THRESHOLD:
+            self.down_since = self.last_probe = time.time()
+            logger.critical('Destination %s unreachable after %d consecutive '
+                    'failures. Suspending sync and probing every %d '
+                    'seconds.' % (self.name, self.failures,
+                        DEST_PROBE_INTERVAL))
+
+
+class BandwidthPolicy(object):
+    """Global bandwidth budget shared by all concurrent transfers. Budget
+    comes from BANDWIDTH_FILE if present, from matching BANDWIDTH_WINDOWS
+    entry or finally from BANDWIDTH_LIMIT. rsync transfers keep the
+    --bwlimit they were started with, and what they leave of the budget
+    is split evenly among running native transfers, which are told their
+    new rate through a rate file whenever a transfer starts or finishes
+    or budget changes. The same goes for per-destination limits, so the
+    total stays within them.
     """
-    global FilesSyncQueue
-    global logger
+    def __init__(self):
+        # running rsync transfers {(destination, path): KBps}
+        self.fixed = {}
+        # running native transfers {(destination, path): [KBps, rate file]}
+        self.native = {}
+        self.override = None
+        self.override_mtime = None
+        self.last_budget = None
 
-    # reread fresh status on every run
-    FilesSyncQueue = read_atomic(FILES_SYNC_FILE)
+    def budget(self):
+        """Get current global budget. Returns KBps or 0 if unlimited.
+        """
+        # runtime override, reread only when changed
+        try:
+            mtime = os.stat(BANDWIDTH_FILE).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self.override_mtime:
+            self.override_mtime = mtime
+            self.override = None
+            if mtime is not None:
+                try:
+                    self.override = int(open(BANDWIDTH_FILE).read().strip())
+                except (IOError, ValueError):
+                    logger.warn('Unusable bandwidth override file %s. '
+                            'Ignoring.' % BANDWIDTH_FILE)
 
-    # ignore if no actions pending
-    if len(FilesSyncQueue) == 0:
-        return False
+        if self.override is not None:
+            budget = self.override
+        else:
+            budget = BANDWIDTH_LIMIT
+            now = time.localtime()
+            for days, start, end, limit in BANDWIDTH_WINDOWS:
+                if now.tm_wday in days and start <= now.tm_hour < end:
+                    budget = limit
+                    break
+
+        if budget != self.last_budget:
+            logger.info('Bandwidth budget is now %d KBps.' % budget)
+            self.last_budget = budget
+        return budget
+
+    def rates(self, extra=None):
+        """Compute rate of every running native transfer and of an extra
+        (destination, path) transfer about to start: they split evenly
+        what rsync transfers leave of global budget and of limit of their
+        destination, whichever is less. Returns {(destination, path):
+        KBps}, 0 meaning unlimited.
+        """
+        flexible = self.native.keys()
+        if extra:
+            flexible.append(extra)
+        rates = dict.fromkeys(flexible, 0)
+        limits = [(self.budget(), None)] + [(d.config['bwlimit'], d.name)
+                for d in Destinations]
+        for limit, name in limits:
+            mine = [k for k in flexible if name in (None, k[0])]
+            if not limit or not mine:
+                continue
+            held = sum([v for k, v in self.fixed.items()
+                if name in (None, k[0])])
+            # budget lowered under what rsync transfers hold, native ones
+            # crawl until those finish
+            share = max(1, (limit - held) / len(mine))
+            for key in mine:
+                if not rates[key] or share < rates[key]:
+                    rates[key] = share
+        return rates
+
+    def admits(self, destination, path):
+        """Check if a new transfer would get at least BANDWIDTH_MIN.
+        Returns True if yes, False otherwise.
+        """
+        key = (destination.name, path)
+        rate = self.rates(key)[key]
+        return not rate or rate >= BANDWIDTH_MIN
+
+    def rate_path(self, destination, path):
+        """Returns path of rate file of a native transfer.
+        """
+        return '%s.%s.%s' % (BANDWIDTH_FILE, destination.name,
+                hashlib.sha1(path).hexdigest())
+
+    def allocate(self, destination, path, native):
+        """Allocate bandwidth for a new transfer to destination, slowing
+        down running native transfers to make room. Returns KBps (0 means
+        unlimited) to be used as --bwlimit or initial rate of native
+        transfer.
+        """
+        key = (destination.name, path)
+        rates = self.rates(key)
+        if native:
+            self.native[key] = [None, self.rate_path(destination, path)]
+            self.apply(rates)
+            return self.native[key][0]
+        self.fixed[key] = rates.pop(key)
+        self.apply(rates)
+        return self.fixed[key]
+
+    def apply(self, rates):
+        """Write changed rates of native transfers into their rate files.
+        Does not return anything.
+        """
+        for key, rate in rates.items():
+            entry = self.native.get(key)
+            if entry is None or entry[0] == rate:
+                continue
+            entry[0] = rate
+            ratefile = open(entry[1] + '.tmp', 'w')
+            try:
+                ratefile.write('%d\n' % rate)
+            finally:
+                ratefile.close()
+            os.rename(entry[1] + '.tmp', entry[1])
+
+    def rebalance(self):
+        """Follow budget changes (time windows and override file) in
+        running native transfers. Does not return anything.
+        """
+        if self.native:
+            self.apply(self.rates())
+
+    def release(self, destination, path):
+        """Return bandwidth of a finished transfer to running native
+        transfers. Does not return anything.
+        """
+        key = (destination.name, path)
+        self.fixed.pop(key, None)
+        entry = self.native.pop(key, None)
+        if entry is not None:
+            try:
+                os.remove(entry[1])
+            except OSError:
+                pass
+        self.rebalance()
+
+
+class RemoteManifest(object):
+    """Cached manifest of remote directory of a watch root on destination
+    {relpath: (size, mtime, permissions, digest)}, fetched with
+    MANIFEST_COMMAND only when there is no cached one and afterwards kept
+    up to date with what syncer changes remotely. Digest is None when not
+    known.
+    """
+    def __init__(self, name, command, rootpath):
+        self.name = name
+        self.command = command
+        self.rootpath = rootpath
+        self.path = '%s.%s' % (FILES_MANIFEST_FILE, name)
+        self.files = {}
+        self.dirty = False
+        # only loaded or successfully fetched manifest is ever saved
+        self.usable = False
+        # fetch in progress and changes done meanwhile
+        self.result = None
+        self.journal = []
+        # time to retry failed fetch, syncs are not held after a failure
+        self.retry = None
+        self.failed = False
+
+    def load(self):
+        """Load cached manifest or start fetching it. Does not return
+        anything.
+        """
+        try:
+            self.files = read_atomic(self.path)
+            self.usable = True
+            return
+        except (IOError, AttributeError, EOFError):
+            pass
+        logger.warn('No usable manifest %s for %s. Fetching.' % (self.path,
+            self.name))
+        self.fetch()
+
+    def fetch(self):
+        """Start fetching manifest. Does not return anything."""
+        self.result = CommandsResult([(self.command, MANIFEST_TIMEOUT)],
+                limit=None)
+
+    def fetching(self):
+        """Returns True if manifest is being fetched."""
+        return self.result is not None
 
-    # pop the necessary values from sync queue
-    poporig = FilesSyncQueue.popleft()
-    myfile, action, myperm = poporig
+    def holding(self):
+        """Check if syncs should wait for manifest: only while it is being
+        fetched and no fetch has failed yet. Returns True if yes, False
+        otherwise.
+        """
+        return self.result is not None and not self.failed
 
-    # check if file exists at all when resyncing and forget action if not
-    if action == 'sync' and not os.path.exists(myfile):
-        logger.info('Tried to sync nonexisting file %s. Ignoring.' %
-                myfile)
-        check_updated(poporig)
-        return
+    def reap(self):
+        """Collect fetched manifest and save it if changed, or retry
+        failed fetch when it is time. Does not return anything.
+        """
+        if self.result is None and self.retry is not None and \
+                time.time() >= self.retry:
+            logger.warn('Fetching manifest for %s again.' % self.name)
+            self.retry = None
+            self.fetch()
 
-    # get relative path of file and relative path of directories above
-    _, relpath = myfile.split('%s/' % WATCH_DIR)
+        if self.result is not None and self.result.ready():
+            retval = self.result.get()
+            self.result = None
+            if retval[0] != 0:
+                logger.warn('Fetching manifest for %s failed with error %d. '
+                        'Syncing everything, retrying in %d seconds.' %
+                        (self.name, retval[0], MANIFEST_RETRY_INTERVAL))
+                self.files = {}
+                self.retry = time.time() + MANIFEST_RETRY_INTERVAL
+                self.failed = True
+            else:
+                self.files = {}
+                for line in retval[1].splitlines():
+                    try:
+                        digest, size, mtime, perm, relpath = \
+                                line.split(' ', 4)
+                        self.files[relpath] = (int(size), int(mtime), perm,
+                                digest)
+                    except ValueError:
+                        continue
+                logger.info('Fetched manifest of %d files for %s.' %
+                        (len(self.files), self.name))
+                self.usable = True
+                self.failed = False
+            # replay changes done remotely in the meantime
+            for args in self.journal:
+                self.update(*args)
+            self.journal = []
+            self.dirty = True
 
-    # return values
-    retval = None
+        if self.dirty and self.usable and self.result is None:
+            write_atomic(self.path, self.files)
+            self.dirty = False
 
-    # execute pre-command on remote directory (usually mkdir)
-    if action == 'sync':
-        # only if synced file in remote subdirectory
-        if relpath.find('/') != -1:
+    def matches(self, myfile, relpath, digest):
+        """Check if remote copy of a file is identical to the local one
+        with given digest (as checksummed by summer). Returns True if yes,
+        False otherwise.
+        """
+        remote = self.files.get(relpath)
+        if not remote or remote[3] is None or digest is None:
+            return False
+        try:
+            mystat = os.stat(myfile)
+        except OSError:
+            return False
+        if remote[:3] != (mystat.st_size, int(mystat.st_mtime),
+                oct(stat.S_IMODE(mystat.st_mode))):
+            return False
+        return digest == remote[3]
+
+    def update(self, action, relpath, arg):
+        """Track remote change done by syncer: arg is local digest (if
+        known) for synced or copied file, permissions for change_perm and
+        relative source path for moves. Does not return anything.
+        """
+        if self.result is not None:
+            self.journal.append((action, relpath, arg))
+            return
+        self.dirty = True
+        prefix = relpath + '/'
+        if action in ('sync', 'copy'):
+            try:
+                mystat = os.stat(os.path.join(self.rootpath, relpath))
+            except OSError:
+                self.files.pop(relpath, None)
+                return
+            self.files[relpath] = (mystat.st_size, int(mystat.st_mtime),
+                    oct(stat.S_IMODE(mystat.st_mode)), arg)
+        elif action == 'change_perm' and relpath in self.files:
+            self.files[relpath] = self.files[relpath][:2] + (arg,) + \
+                    self.files[relpath][3:]
+        elif action == 'remove':
+            self.files.pop(relpath, None)
+        elif action == 'remove_dir':
+            for path in self.files.keys():
+                if path.startswith(prefix):
+                    del self.files[path]
+        elif action == 'move':
+            if arg in self.files:
+                self.files[relpath] = self.files.pop(arg)
+        elif action == 'move_dir':
+            for path in self.files.keys():
+                if path.startswith(arg + '/'):
+                    self.files[relpath + path[len(arg):]] = \
+                            self.files.pop(path)
+
+
+class SpillSegments(object):
+    """Overflow of a sync queue on disk, in numbered append-only segment
+    files of at most size actions each, read back oldest first.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        # [segment number, number of actions], oldest first
+        self.segments = []
+        # segment appended to by this process, older ones might end with a
+        # record torn by a crash
+        self.tail = None
+
+    def __len__(self):
+        return sum([x[1] for x in self.segments])
+
+    def load(self):
+        """Find segments left over from previous run. Does not return
+        anything.
+        """
+        directory, prefix = os.path.split(self.path)
+        numbers = []
+        for name in os.listdir(directory or '.'):
+            suffix = name[len(prefix) + 1:]
+            if name.startswith(prefix + '.') and suffix.isdigit():
+                numbers.append(int(suffix))
+        numbers.sort()
+        self.segments = [[x, len(self.read(x))] for x in numbers]
+        if self.segments:
+            logger.warn('Found %d spilled actions in %d segments of %s.' %
+                    (len(self), len(self.segments), self.path))
+
+    def append(self, actions):
+        """Append actions to newest segment, starting a new one when it is
+        full, and flush them to disk. Does not return anything.
+        """
+        segment = None
+        created = False
+        try:
+            for action in actions:
+                if not self.segments or \
+                        self.segments[-1][0] != self.tail or \
+                        self.segments[-1][1] >= self.size:
+                    if segment:
+                        self.close(segment)
+                        segment = None
+                    self.tail = self.segments and \
+                            self.segments[-1][0] + 1 or 0
+                    self.segments.append([self.tail, 0])
+                    created = True
+                if segment is None:
+                    segment = open('%s.%d' % (self.path, self.tail), 'ab')
+                cPickle.dump(action, segment, -1)
+                self.segments[-1][1] += 1
+        finally:
+            if segment:
+                self.close(segment)
+        # new segment files have to be found after a crash too
+        if created:
+            fsync_path(os.path.dirname(self.path) or '.')
+
+    def close(self, segment):
+        """Flush segment file to disk and close it. Does not return
+        anything.
+        """
+        try:
+            segment.flush()
+            os.fsync(segment.fileno())
+        finally:
+            segment.close()
+
+    def read(self, number):
+        """Read all actions of a segment, up to a record torn by a crash.
+        Returns list of actions.
+        """
+        actions = []
+        segment = open('%s.%d' % (self.path, number), 'rb')
+        try:
+            while True:
+                try:
+                    actions.append(cPickle.load(segment))
+                except EOFError:
+                    break
+                except (cPickle.UnpicklingError, AttributeError,
+                        ValueError):
+                    logger.warn('Torn record in spill segment %s.%d after '
+                            '%d actions. Ignoring the rest.' % (self.path,
+                                number, len(actions)))
+                    break
+        finally:
+            segment.close()
+        return actions
+
+    def drop(self, numbers):
+        """Remove segments which have been read back. Does not return
+        anything.
+        """
+        for number in numbers:
+            os.unlink('%s.%d' % (self.path, number))
+        self.segments = [x for x in self.segments if x[0] not in numbers]
+        if self.tail in numbers:
+            self.tail = None
+
+
+class Destination(object):
+    """Single replica destination with its own persistent sync queue,
+    health tracking and remote commands running concurrently.
+    """
+    def __init__(self, config):
+        self.config = {'module': 'dare', 'concurrency': 1, 'bwlimit': 0,
+                'transfer': 'rsync'}
+        self.config.update(config)
+        self.name = self.config['name']
+        self.concurrency = self.config['concurrency']
+        self.queue_file = '%s.%s' % (FILES_SYNC_FILE, self.name)
+        self.queue = collections.deque()
+        # actions beyond SYNC_QUEUE_HIGH wait on disk
+        self.spill = SpillSegments(self.queue_file + '.spill',
+                SYNC_QUEUE_HIGH - SYNC_QUEUE_LOW)
+        self.health = DestinationHealth(self.name,
+                PROBE_COMMAND % self.config)
+        # remote manifest of every watch root
+        self.manifests = {}
+        for root in WATCH_ROOTS:
+            self.manifests[root['name']] = RemoteManifest('%s.%s' %
+                    (self.name, root['name']), MANIFEST_COMMAND %
+                    dict(self.config, root=root['name'],
+                        remote_dir=root['remote_dir']), root['path'])
+        self.scheduler = RootScheduler(WATCH_ROOTS)
+        # in-flight actions {path: (action tuple, async result)}
+        self.inflight = {}
+        # per-file failures {action tuple: (attempts, retry time)}
+        self.failed = {}
+        # remote directories known to exist (relative paths) per root
+        self.remote_dirs = dict([(root['name'], set())
+            for root in WATCH_ROOTS])
+        self.pool = None
+
+    def start(self):
+        """Load persistent sync queue and start worker pool for native
+        transfers. Does not return anything.
+        """
+        # if destination queue is nonexistant or damaged, truncate it
+        try:
+            self.queue = read_atomic(self.queue_file)
+        except (IOError, AttributeError, EOFError):
+            logger.warn('Unusable sync queue file %s. Recreating.' %
+                    self.queue_file)
+        write_atomic(self.queue_file, self.queue)
+        self.spill.load()
+        if self.config['transfer'] == 'native':
+            self.pool = multiprocessing.Pool(self.concurrency)
+        for manifest in self.manifests.values():
+            manifest.load()
+
+    def extend(self, actions):
+        """Append actions to destination sync queue, spilling them to disk
+        when it is full (or already spilled, to keep the order). Does not
+        return anything.
+        """
+        actions = list(actions)
+        room = 0
+        if not self.spill.segments:
+            room = max(SYNC_QUEUE_HIGH - len(self.queue), 0)
+        if room:
+            self.queue.extend(actions[:room])
+            write_atomic(self.queue_file, self.queue)
+        if actions[room:]:
+            self.spill.append(actions[room:])
+            logger.info('Spilled %d actions of %s to disk, %d spilled in '
+                    'total.' % (len(actions) - room, self.name,
+                        len(self.spill)))
+
+    def refill(self):
+        """Read spilled actions back into sync queue once it has drained
+        below SYNC_QUEUE_LOW, as many oldest segments as fit under
+        SYNC_QUEUE_HIGH. Does not return anything.
+        """
+        if not self.spill.segments or len(self.queue) >= SYNC_QUEUE_LOW:
+            return
+        actions = []
+        numbers = []
+        for number, count in self.spill.segments:
+            if numbers and \
+                    len(self.queue) + len(actions) + count > SYNC_QUEUE_HIGH:
+                break
+            actions.extend(self.spill.read(number))
+            numbers.append(number)
+        self.queue.extend(actions)
+        # queue has to be on disk before its segments are gone
+        write_atomic(self.queue_file, self.queue)
+        flush_atomic(self.queue_file)
+        sync_atomic(self.queue_file)
+        self.spill.drop(numbers)
+        logger.info('Read back %d spilled actions of %s, %d still '
+                'spilled.' % (len(actions), self.name, len(self.spill)))
+
+    def backlog(self):
+        """Returns number of actions pending in sync queue, spilled ones
+        included.
+        """
+        return len(self.queue) + len(self.spill)
+
+    def commands(self, poporig, action):
+        """Build list of (command, timeout) for a given action, executed
+        as given action type. Returns None if there is nothing to execute.
+        """
+        myfile, _, myperm = poporig
+
+        # check if file exists at all when resyncing and forget action if
+        # not
+        if action in ('sync', 'copy') and not os.path.exists(myfile):
+            logger.info('Tried to sync nonexisting file %s. Ignoring.' %
+                    myfile)
+            return None
+
+        # get watch root and relative path of file
+        root, relpath = find_root(myfile, WATCH_ROOTS)
+        if root is None:
+            logger.warn('File %s is not in any watch root. Ignoring.' %
+                    myfile)
+            return None
+
+        # synced file carries its checksum and duplicate its source too
+        if poporig[1] in ('sync', 'copy'):
+            mysrc, mydigest, myperm = carried(poporig)
+
+        # remote already has identical copy
+        if action == 'sync' and \
+                self.manifests[root['name']].matches(myfile, relpath,
+                        mydigest):
+            logger.debug('File %s is already on %s. Skipping.' % (myfile,
+                self.name))
+            return None
+
+        args = dict(self.config, root=root['name'],
+                remote_dir=root['remote_dir'], path=myfile, relpath=relpath,
+                perm=myperm)
+        # native receiver creates directories and talks over its own
+        # persistent stream
+        native = action == 'sync' and self.config['transfer'] == 'native'
+
+        # only data transfers are subject to bandwidth policy
+        if action == 'sync':
+            args['bwlimit'] = Bandwidth.allocate(self, myfile, native)
+
+        commands = []
+        # execute pre-command on remote directory (usually mkdir), only if
+        # synced or moved file in remote subdirectory not known to exist
+        if action in ('sync', 'copy', 'move', 'move_dir') and \
+                relpath.find('/') != -1 and not native and \
+                os.path.dirname(relpath) not in \
+                self.remote_dirs[root['name']]:
             relpathdir, _ = relpath.rsplit('/', 1)
-            logger.debug('Executing pre_command: %s.' % PRE_COMMAND %
-                    relpathdir)
-            retval = run_with_timeout(PRE_COMMAND % relpathdir, shell=True,
-                    timeout=600)
-
-        logger.debug('Executing sync_command: %s.' % SYNC_COMMAND %
-                (myfile, relpath))
-        retval = run_with_timeout(SYNC_COMMAND % (myfile, relpath),
-                shell=True, timeout=3600)
-
-        # most fatal error, log stdout and stderr too
-        if retval[0] != 0 and retval[0] != -9:
-            logger.critical('Fatal error %d when syncing remote file %s. '
-                    'STDOUT: %s. STDERR: %s.' % (retval[0], myfile,
-                        retval[1], retval[2]))
-            #sys.exit(1)
-
-    # remove remote file
-    elif action == 'remove':
-        logger.debug('Executing remove_command: %s.' % REMOVE_COMMAND %
-                relpath)
-        retval = run_with_timeout(REMOVE_COMMAND % relpath, shell=True,
-                timeout=600)
-
-    # make remote directory with given permissions
-    elif action == 'make_dir':
-        logger.debug('Executing make_dir_command: %s.' % MAKE_DIR_COMMAND
-                % (myperm, relpath))
-        retval = run_with_timeout(MAKE_DIR_COMMAND % (myperm, relpath),
-                shell=True, timeout=600)
-
-    # remove remote directory
-    elif action == 'remove_dir':
-        logger.debug('Executing remove_dir_command: %s.' %
-                REMOVE_DIR_COMMAND % relpath)
-        retval = run_with_timeout(REMOVE_DIR_COMMAND % relpath,
-                shell=True, timeout=600)
-
-    # change permissions of a remote file or directory
+            commands.append((PRE_COMMAND % dict(args, relpath=relpathdir),
+                600))
+
+        if native:
+            commands.append(((transfer.transfer_file, (RECEIVER_COMMAND %
+                args, myfile, relpath, FILES_BLOCKS_DIR, TRANSFER_BLOCK_SIZE,
+                args['bwlimit'], TRANSFER_TIMEOUT, TRANSFER_RESUME_MIN_SIZE,
+                Bandwidth.rate_path(self, myfile))), 3600))
+        elif action == 'sync':
+            commands.append((SYNC_COMMAND % args, 3600))
+        # move remote file or directory, source path is in place of
+        # permissions
+        elif action in ('move', 'move_dir'):
+            _, srcrelpath = find_root(myperm, WATCH_ROOTS)
+            commands.append((MOVE_COMMAND % dict(args,
+                srcrelpath=srcrelpath), 600))
+        # copy remote duplicate and print its checksum
+        elif action == 'copy':
+            _, srcrelpath = find_root(mysrc, WATCH_ROOTS)
+            commands.append((COPY_COMMAND % dict(args,
+                srcrelpath=srcrelpath), 3600))
+        # remove remote file
+        elif action == 'remove':
+            commands.append((REMOVE_COMMAND % args, 600))
+        # make remote directory with given permissions
+        elif action == 'make_dir':
+            commands.append((MAKE_DIR_COMMAND % args, 600))
+        # remove remote directory
+        elif action == 'remove_dir':
+            commands.append((REMOVE_DIR_COMMAND % args, 600))
+        # change permissions of a remote file or directory
+        elif action == 'change_perm':
+            commands.append((CHMOD_COMMAND % args, 600))
+        return commands
+
+    def dispatch(self):
+        """Hand over pending actions to workers, never running two
+        actions on the same path or on a path and its parent directory at
+        the same time, to keep per-path ordering. Actions of different
+        watch roots are dispatched in proportion to root priorities.
+        Returns number of dispatched actions.
+        """
+        if not self.health.is_up() or \
+                len(self.inflight) >= self.concurrency:
+            return 0
+
+        # actions which could run now, per root in queue order; paths
+        # touched by earlier actions are blocked, and so are directories
+        # above them
+        eligible = {}
+        blocked = set()
+        parents = set()
+        for poporig, _, _ in self.inflight.values():
+            block_paths(action_paths(poporig), blocked, parents)
+        for i, poporig in enumerate(self.queue):
+            if i >= DISPATCH_WINDOW:
+                break
+            if block_paths(action_paths(poporig), blocked, parents):
+                continue
+
+            # retry postponed after per-file error
+            if poporig in self.failed and \
+                    self.failed[poporig][1] > time.time():
+                continue
+
+            root, _ = find_root(poporig[0], WATCH_ROOTS)
+            # remote manifest of root is being fetched, file synced now
+            # might be there already
+            if root and poporig[1] == 'sync' and \
+                    self.manifests[root['name']].holding():
+                continue
+            eligible.setdefault(root and root['name'], []).append(poporig)
+
+        dispatched = 0
+        finished = []
+        while eligible and len(self.inflight) < self.concurrency:
+            name = self.scheduler.pick(eligible.keys())
+            poporig = eligible[name].pop(0)
+            if not eligible[name]:
+                del eligible[name]
+            myfile = poporig[0]
+
+            # remote copy of a duplicate is only safe if its source has
+            # been replicated already, otherwise send it over
+            action = poporig[1]
+            if action == 'copy' and self.pending(poporig[2][0]):
+                action = 'sync'
+            # bandwidth budget is taken by running transfers
+            if action == 'sync' and not Bandwidth.admits(self, myfile):
+                continue
+
+            commands = self.commands(poporig, action)
+            if not commands:
+                finished.append(poporig)
+                continue
+            for command, _ in commands:
+                logger.debug('Executing on %s: %s.' % (self.name, command))
+            # shell commands are run by Runner in this process, native
+            # transfers in workers keeping their streams open
+            if isinstance(commands[0][0], tuple):
+                result = self.pool.apply_async(run_commands, (commands,))
+            else:
+                result = CommandsResult(commands)
+            self.inflight[myfile] = (poporig, action, result)
+            dispatched += 1
+
+        for poporig in finished:
+            self.done(poporig)
+        return dispatched
+
+    def reap(self):
+        """Collect results of finished workers. Does not return anything.
+        """
+        for myfile, (poporig, action, result) in self.inflight.items():
+            if not result.ready():
+                continue
+            del self.inflight[myfile]
+            Bandwidth.release(self, myfile)
+            self.complete(poporig, action, result.get())
+        for manifest in self.manifests.values():
+            manifest.reap()
+
+    def complete(self, poporig, action, retval):
+        """Decide what to do with action after remote commands have
+        finished, given the type it was executed as. Does not return
+        anything.
+        """
+        myfile = poporig[0]
+
+        if retval[0] in CONNECTION_ERRORS:
+            # remote unreachable, leave action on queue and let destination
+            # health decide when to retry
+            logger.warn('Remote action %s on file %s failed on %s with '
+                    'connection error %d.' % (action, myfile, self.name,
+                        retval[0]))
+            self.health.record_failure()
+            return
+
+        # remote is obviously reachable
+        self.health.record_success()
+        self.track_dirs(poporig, action, retval[0] == 0)
+
+        # remote copy of a duplicate failed or does not match expected
+        # checksum, send it over instead
+        if action == 'copy' and (retval[0] != 0 or
+                not retval[1].startswith(poporig[2][1])):
+            logger.warn('Remote copy of %s on %s failed or does not match '
+                    'its checksum. Resyncing.' % (myfile, self.name))
+            self.replace(poporig, [(myfile, 'sync',
+                (None,) + poporig[2][1:])])
+            return
+
+        # remote move failed (source most probably not there), fall back
+        # to removal and full resync
+        if retval[0] != 0 and action in ('move', 'move_dir'):
+            logger.warn('Remote action %s on file %s failed on %s with error '
+                    '%d. Falling back to remove and resync.' % (action,
+                        myfile, self.name, retval[0]))
+            self.replace(poporig, fallback_actions(poporig))
+            return
+
+        if retval[0] != 0:
+            # most fatal error, log stdout and stderr too
+            logger.critical('Fatal error %d for remote action %s on file %s '
+                    'on %s. STDOUT: %s. STDERR: %s.' % (retval[0], action,
+                        myfile, self.name, retval[1], retval[2]))
+
+            # per-file error, keep action and retry with growing backoff
+            # unless file has vanished
+            if retval[0] not in VANISHED_ERRORS:
+                attempts = self.failed.get(poporig, (0, 0))[0] + 1
+                delay = min(TIMEOUT_SLEEP_TIME * 2 ** (attempts - 1),
+                        SYNC_RETRY_MAX_INTERVAL)
+                logger.warn('Remote action %s on file %s failed on %s '
+                        '(attempt %d). Retrying in %d seconds.' % (action,
+                            myfile, self.name, attempts, delay))
+                self.failed[poporig] = (attempts, time.time() + delay)
+                return
+            logger.warn('File %s vanished, dropping remote action %s on '
+                    '%s.' % (myfile, action, self.name))
+
+        else:
+            # native transfers report logical and allocated sizes
+            if action == 'sync' and retval[1]:
+                logger.info('Synced file %s to %s: %s.' % (myfile,
+                    self.name, retval[1].strip()))
+            root, _ = find_root(myfile, WATCH_ROOTS)
+            self.manifests[root['name']].update(*manifest_change(poporig,
+                action))
+
+        self.done(poporig)
+
+    def track_dirs(self, poporig, action, succeeded):
+        """Update cache of remote directories known to exist after an
+        action has been executed. Does not return anything.
+        """
+        myfile, _, mysrc = poporig
+        root, relpath = find_root(myfile, WATCH_ROOTS)
+        remote_dirs = self.remote_dirs[root['name']]
+        if action == 'remove_dir':
+            self.forget_dir(remote_dirs, relpath)
+        elif action == 'move_dir':
+            _, srcrelpath = find_root(mysrc, WATCH_ROOTS)
+            self.forget_dir(remote_dirs, srcrelpath)
+
+        # failure might mean directory has vanished remotely, so check it
+        # next time
+        if not succeeded:
+            self.forget_dir(remote_dirs, os.path.dirname(relpath))
+            return
+        if action in ('make_dir', 'move_dir'):
+            self.add_dir(remote_dirs, relpath)
+        elif action in ('sync', 'copy', 'move'):
+            self.add_dir(remote_dirs, os.path.dirname(relpath))
+
+    def add_dir(self, remote_dirs, relpath):
+        """Remember remote directory and all above it as existing in
+        remote_dirs set of its root. Does not return anything.
+        """
+        while relpath and relpath not in remote_dirs:
+            remote_dirs.add(relpath)
+            relpath = os.path.dirname(relpath)
+
+    def forget_dir(self, remote_dirs, relpath):
+        """Forget remote directory and all below it in remote_dirs set of
+        its root. Does not return anything.
+        """
+        prefix = relpath + '/'
+        for path in list(remote_dirs):
+            if path == relpath or path.startswith(prefix):
+                remote_dirs.discard(path)
+
+    def done(self, poporig):
+        """Final removal of action from sync queue after all is done. Does
+        not return anything.
+        """
+        self.failed.pop(poporig, None)
+        try:
+            self.queue.remove(poporig)
+        except ValueError:
+            logger.warn('Oops, action %s vanished from sync queue of %s. '
+                    'This should never happen.' % (poporig, self.name))
+        write_atomic(self.queue_file, self.queue)
+
+    def pending(self, path):
+        """Check if there is any action still pending or in flight for a
+        given path. Returns True if yes, False otherwise.
+        """
+        for poporig in self.queue:
+            if poporig[0] == path:
+                return True
+        return False
+
+    def replace(self, poporig, actions):
+        """Replace action in sync queue with a list of actions, keeping
+        its position. Does not return anything.
+        """
+        self.failed.pop(poporig, None)
+        queue = list(self.queue)
+        i = queue.index(poporig)
+        self.queue = collections.deque(queue[:i] + actions + queue[i + 1:])
+        write_atomic(self.queue_file, self.queue)
+
+
+def action_paths(poporig):
+    """Get all local paths an action touches. Returns list of paths.
+    """
+    myfile, action, mysrc = poporig
+    if action in ('move', 'move_dir'):
+        return [myfile, mysrc]
+    if action == 'copy':
+        return [myfile, mysrc[0]]
+    return [myfile]
+
+def carried(poporig):
+    """Split argument of sync or copy action into (source of duplicate,
+    checksum, permissions); source and checksum are None if not carried
+    along (resyncs done by syncer itself). Returns tuple.
+    """
+    if isinstance(poporig[2], tuple):
+        return poporig[2]
+    return None, None, poporig[2]
+
+def manifest_change(poporig, action):
+    """Translate successfully executed action into manifest change.
+    Returns (action, relpath, argument) for RemoteManifest.update().
+    """
+    myfile, _, myperm = poporig
+    _, relpath = find_root(myfile, WATCH_ROOTS)
+    arg = None
+    if action in ('sync', 'copy'):
+        arg = carried(poporig)[1]
     elif action == 'change_perm':
-        logger.debug('Executing change_perm: %s.' % CHMOD_COMMAND %
-                (myperm, relpath))
-        retval = run_with_timeout(CHMOD_COMMAND % (myperm, relpath),
-                shell=True, timeout=600)
-
-    if retval and retval[0] != 0:
-        # remote command timeouted, print reasons in 1/stdout and 2/stderr
-        # and sleep for extended time
-        logger.warn('Remote action %s on file %s failed. Sleeping.' %
-                (action, relpath))
-        time.sleep(TIMEOUT_SLEEP_TIME)
-        return
-
-    # final pop and delete after all is done
-    check_updated(poporig)
+        arg = myperm
+    elif action in ('move', 'move_dir'):
+        _, arg = find_root(myperm, WATCH_ROOTS)
+    return action, relpath, arg
+
+def fallback_actions(poporig):
+    """Translate remote move into remote removal of source and resync of
+    destination (for directories of everything below it). Returns list of
+    actions.
+    """
+    myfile, action, mysrc = poporig
+    if action == 'move':
+        return [(mysrc, 'remove', None), (myfile, 'sync', None)]
+
+    actions = [(mysrc, 'remove_dir', None)]
+    for root, dirs, files in os.walk(myfile):
+        try:
+            myperm = oct(stat.S_IMODE(os.stat(root)[stat.ST_MODE]))
+        except (IOError, OSError):
+            continue
+        actions.append((root, 'make_dir', myperm))
+        for name in files:
+            actions.append((os.path.join(root, name), 'sync', None))
+    return actions
+
+def parent_dirs(path):
+    """Returns list of directories above (absolute) path, nearest first.
+    """
+    parents = []
+    i = path.rfind('/')
+    while i > 0:
+        path = path[:i]
+        parents.append(path)
+        i = path.rfind('/')
+    return parents
+
+def block_paths(paths, blocked, parents):
+    """Add paths of an action to blocked set and directories above them to
+    parents set. Returns True if any of them was blocked already (the same
+    as, above or below a blocked path), False otherwise.
+    """
+    related = False
+    above = []
+    for path in paths:
+        mydirs = parent_dirs(path)
+        if path in blocked or path in parents or \
+                not blocked.isdisjoint(mydirs):
+            related = True
+        above.append(mydirs)
+    for path, mydirs in zip(paths, above):
+        blocked.add(path)
+        parents.update(mydirs)
+    return related
 
+def run_commands(commands):
+    """Run given (command, timeout) list in order, stopping on first error;
+    command is either shell command or (function, arguments) tuple, the
+    latter given deadline (absolute time) it has to keep itself. Executed
+    in worker processes of native transfers. Returns return code, stdout
+    and stderr of the last executed command.
+    """
+    retval = (0, '', '')
+    for command, timeout in commands:
+        if isinstance(command, tuple):
+            function, args = command
+            retval = function(*args, deadline=time.time() + timeout)
+        else:
+            retval = run_with_timeout(command, shell=True, timeout=timeout)
+        if retval[0] != 0:
+            break
+    return retval
+
+def throttled():
+    """Check destination backlogs against watermarks: taking actions from
+    summer stops once every destination has SYNC_QUEUE_HIGH actions pending,
+    until one of them drains below SYNC_QUEUE_LOW (a single destination
+    falling behind only spills to disk). Returns True if throttled, False
+    otherwise.
+    """
+    global Throttled
+
+    backlog = min([x.backlog() for x in Destinations] or [0])
+    if not Throttled and backlog >= SYNC_QUEUE_HIGH:
+        logger.warn('All destinations have at least %d actions pending. '
+                'Holding back summer sync queue.' % backlog)
+        Throttled = True
+    elif Throttled and backlog < SYNC_QUEUE_LOW:
+        logger.warn('Destination backlog drained to %d actions. Resuming.' %
+                backlog)
+        Throttled = False
+    return Throttled
+
+def fanout():
+    """Move all pending actions from summer sync queue into every
+    destination sync queue, unless destinations are too far behind.
+    Returns False if no actions were moved.
+    """
+    if throttled():
+        return False
+    FilesSyncQueue = list(read_atomic(FILES_SYNC_FILE))
+    if len(FilesSyncQueue) == 0:
+        return False
+    # destination queues have to be on disk before actions leave summer
+    # sync queue: a crash in between repeats them rather than losing them
+    for destination in Destinations:
+        destination.extend(FilesSyncQueue)
+        flush_atomic(destination.queue_file)
+        sync_atomic(destination.queue_file)
+    trim_atomic(FILES_SYNC_FILE, len(FilesSyncQueue))
+    logger.debug('Fanned out %d actions to %d destinations.' %
+            (len(FilesSyncQueue), len(Destinations)))
     return True
 
+def decisionlogic():
+    """Main decision/syncing loop. Returns False if there is nothing in
+flight nor dispatched.
+    """
+    fanout()
+    Bandwidth.rebalance()
+
+    busy = False
+    for destination in Destinations:
+        destination.reap()
+        destination.refill()
+        if destination.dispatch() or destination.inflight or \
+                destination.health.probing() or \
+                [x for x in destination.manifests.values()
+                    if x.fetching()]:
+            busy = True
+    return busy
+
+def setup():
+    """Check watch roots, recreate sync queue if needed and start
+    destinations. Does not return anything.
+    """
+    global Destinations
+    global Bandwidth
+    global Runner
+
+    # sanity check
+    for root in WATCH_ROOTS:
+        if not os.path.isdir(root['path']):
+            logger.critical('Watched directory %s does not exist. '
+                    'Bailing out.' % root['path'])
+            sys.exit(1)
+
+    # if FilesSyncQueue is nonexistant or damaged, truncate it
+    try:
+        read_atomic(FILES_SYNC_FILE)
+    except (IOError, AttributeError, EOFError):
+        logger.warn('Unusable file sync queue file %s. Recreating.' %
+                FILES_SYNC_FILE)
+        write_atomic(FILES_SYNC_FILE, collections.deque())
+
+    # global bandwidth budget and runner of all remote commands
+    Bandwidth = BandwidthPolicy()
+    Runner = ProcessRunner()
+
+    # per-destination sync queues and workers
+    for config in DESTINATIONS:
+        destination = Destination(config)
+        destination.start()
+        Destinations.append(destination)
+
 def main(argv):
-    global FilesSyncQueue
     global logger
     global foreground
 
@@ -165,26 +1192,13 @@ def main(argv):
     logger = setup_logging(argv[0], CONSOLE_LOG_LEVEL, FILE_LOG_LEVEL,
             LOG_FORMAT, SYNCER_LOG, DATE_FORMAT)
 
-    # sanity check
-    if not os.path.isdir(WATCH_DIR):
-        logger.critical('Watched directory %s does not exist. '
-                'Bailing out.' % WATCH_DIR)
-        sys.exit(1)
-
-    # if FilesSyncQueue is nonexistant or damaged, truncate it
-    try:
-        FilesSyncQueue = read_atomic(FILES_SYNC_FILE)
-    except (IOError, AttributeError, EOFError):
-        logger.warn('Unusable file sync queue file %s. Recreating.' %
-                FILES_SYNC_FILE)
-        pass
-    write_atomic(FILES_SYNC_FILE, FilesSyncQueue)
+    setup()
 
     # start main loop
     logger.debug('File sync service starting... Entering wait loop.')
     while True:
         while decisionlogic():
-            pass
+            Runner.poll(1)
         time.sleep(SLEEP_TIME)
 
 if __name__ == '__main__':
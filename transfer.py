@@ -0,0 +1,785 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+
+"""Native block-level transfer part of BlackMesa Disaster Recovery project
+
+Sender runs inside syncer workers and talks to the receiver agent over a
+single persistent stream (stdin/stdout of RECEIVER_COMMAND, usually over
+ssh). Receiver can be started locally for testing with:
+
+    python transfer.py /path/to/replica /path/to/receiver/state
+
+The same script prints manifest of a replica for syncer (MANIFEST_COMMAND),
+rehashing only files changed since the last run:
+
+    python transfer.py --manifest /path/to/replica /path/to/cache
+"""
+
+__copyright__ = """Copyright (C) 2010  Dinko Korunic, InfoMAR
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program; if not, write to the Free Software Foundation, Inc.,
+59 Temple Place, Suite 330, Boston, MA  02111-1307 USA
+"""
+
+__version__ = '$Id: transfer.py,v de859cceb463 2010/10/28 09:10:17 dinko $'
+
+
+import os
+import sys
+import stat
+import time
+import errno
+import fcntl
+import select
+import struct
+import hashlib
+import cPickle
+import ctypes
+import ctypes.util
+import subprocess
+
+from common import sha1sum, read_blocks
+
+
+# every message is a header (operation, number, payload length) followed
+# by payload; operations sent by sender are 'O' (open file, number is file
+# size), 'D' (data, number is offset), 'H' (hole, number is offset and
+# payload its length), 'C' (commit, number is file size) and 'Q' (quit),
+# while receiver answers with 'B' (known block digests, number is block
+# size), 'K' (ok, payload is allocated size of replica) or 'E' (error,
+# payload is message)
+HEADER = struct.Struct('!cQI')
+
+# lseek(2) whence values for finding data and holes in sparse files, and
+# fallocate(2) mode for punching holes (FALLOC_FL_PUNCH_HOLE |
+# FALLOC_FL_KEEP_SIZE), all Linux specific
+SEEK_DATA = 3
+SEEK_HOLE = 4
+FALLOC_PUNCH_HOLE = 3
+
+# return codes handed back to syncer: stream is broken (treated as
+# connection failure just like ssh(1) 255), per-file error or deadline of
+# the whole transfer passed (just like command killed after timeout)
+STREAM_ERROR = 255
+FILE_ERROR = 1
+DEADLINE_ERROR = -9
+
+# length of hex digest
+DIGEST_LEN = 40
+
+# receiver persists progress of resumable transfer after this many blocks
+PROGRESS_BLOCKS = 64
+
+# senders of this worker process {receiver command: Sender}
+Senders = {}
+
+# C library for fallocate(2), None if not available
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+            ctypes.c_int64]
+except (OSError, AttributeError):
+    libc = None
+
+
+class StreamError(Exception):
+    """Raised when stream to/from receiver is broken or timeouted."""
+    pass
+
+
+class DeadlineError(StreamError):
+    """Raised when transfer has run past its deadline."""
+    pass
+
+
+class TokenBucket(object):
+    """Token bucket limiting sender bandwidth to a given rate in KBps (0
+    means unlimited), allowing bursts of up to one second worth of data.
+    Rate is reread every second from rate file if given, so that it can be
+    changed while transfer is running, and no sleep goes past deadline.
+    """
+    def __init__(self, rate, ratefile=None, deadline=None):
+        self.rate = rate * 1024
+        self.tokens = self.rate
+        self.last = time.time()
+        self.ratefile = ratefile
+        self.checked = self.last
+        self.deadline = deadline
+
+    def consume(self, size):
+        """Take size tokens from bucket, sleeping until there are enough of
+        them. Does not return anything.
+        """
+        now = time.time()
+        if self.ratefile and now - self.checked >= 1:
+            self.checked = now
+            try:
+                self.rate = int(open(self.ratefile).read().strip()) * 1024
+            except (IOError, ValueError):
+                pass
+        if not self.rate:
+            self.last = now
+            return
+        self.tokens = min(self.rate, self.tokens + (now - self.last) *
+                self.rate)
+        self.last = now
+        self.tokens -= size
+        if self.tokens < 0:
+            delay = -self.tokens / float(self.rate)
+            if self.deadline is not None:
+                delay = max(0, min(delay, self.deadline - now))
+            time.sleep(delay)
+
+
+def data_extents(fd, size):
+    """Find data extents of a possibly sparse file. Returns list of
+    (offset, length); whole file is a single extent if filesystem does not
+    support SEEK_DATA/SEEK_HOLE.
+    """
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError, err:
+                # no more data up to the end of file
+                if err.errno == errno.ENXIO:
+                    break
+                raise
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            extents.append((start, end - start))
+            offset = end
+    except OSError:
+        return [(0, size)]
+    return extents
+
+def punch_hole(myfile, offset, length):
+    """Deallocate given range of a file, or write zeros over it if hole
+    punching is not supported. Does not return anything.
+    """
+    myfile.flush()
+    if libc is not None and libc.fallocate(myfile.fileno(),
+            FALLOC_PUNCH_HOLE, offset, length) == 0:
+        return
+    myfile.seek(offset)
+    while length > 0:
+        chunk = min(length, 1048576)
+        myfile.write('\0' * chunk)
+        length -= chunk
+
+def split_extents(extents, offset, length):
+    """Split given range into data and hole pieces according to data
+    extents. Returns list of (is data, offset, length).
+    """
+    pieces = []
+    end = offset + length
+    for start, size in extents:
+        start, stop = max(start, offset), min(start + size, end)
+        if start >= stop:
+            continue
+        if start > offset:
+            pieces.append((False, offset, start - offset))
+        pieces.append((True, start, stop - start))
+        offset = stop
+    if offset < end:
+        pieces.append((False, offset, end - offset))
+    return pieces
+
+
+class Stream(object):
+    """Framed message stream over a pair of file descriptors. With timeout,
+    writes are non-blocking so a stalled peer cannot hang the writer; no
+    wait goes past deadline (absolute time) either, if set.
+    """
+    def __init__(self, rfd, wfd, timeout=None):
+        self.rfd = rfd
+        self.wfd = wfd
+        self.timeout = timeout
+        self.deadline = None
+        if timeout is not None:
+            fcntl.fcntl(wfd, fcntl.F_SETFL, fcntl.fcntl(wfd, fcntl.F_GETFL) |
+                    os.O_NONBLOCK)
+
+    def wait(self, rfds, wfds, what):
+        """Wait until stream can be read or written, at most timeout
+        seconds and not past deadline. Does not return anything.
+        """
+        wait = self.timeout
+        if self.deadline is not None:
+            left = self.deadline - time.time()
+            if left <= 0:
+                raise DeadlineError('deadline passed %s stream' % what)
+            if wait is None or left < wait:
+                wait = left
+        if wait is None:
+            return
+        ready = select.select(rfds, wfds, [], wait)
+        if ready[0] or ready[1]:
+            return
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise DeadlineError('deadline passed %s stream' % what)
+        raise StreamError('timeout %s stream' % what)
+
+    def read_exactly(self, size):
+        """Read exactly size bytes, waiting at most timeout seconds for
+        each chunk. Returns string.
+        """
+        chunks = []
+        while size > 0:
+            self.wait([self.rfd], [], 'reading from')
+            try:
+                chunk = os.read(self.rfd, min(size, 1048576))
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise StreamError(str(err))
+            if not chunk:
+                raise StreamError('unexpected end of stream')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def read(self):
+        """Read a single message. Returns (operation, number, payload).
+        """
+        op, number, length = HEADER.unpack(self.read_exactly(HEADER.size))
+        return op, number, self.read_exactly(length)
+
+    def write(self, op, number=0, payload=''):
+        """Write a single message, waiting at most timeout seconds for
+        each chunk to be taken. Does not return anything.
+        """
+        data = HEADER.pack(op, number, len(payload)) + payload
+        offset = 0
+        while offset < len(data):
+            self.wait([], [self.wfd], 'writing to')
+            try:
+                written = os.write(self.wfd, buffer(data, offset))
+            except OSError, err:
+                if err.errno in (errno.EINTR, errno.EAGAIN):
+                    continue
+                raise StreamError(str(err))
+            offset += written
+
+
+class Sender(object):
+    """Sending side, keeps receiver process and stream to it open between
+    transfers.
+    """
+    def __init__(self, command, timeout):
+        self.command = command
+        self.timeout = timeout
+        self.process = None
+        self.stream = None
+
+    def connect(self):
+        """Start receiver if not running. Does not return anything.
+        """
+        if self.process is not None:
+            return
+        self.process = subprocess.Popen(self.command, shell=True,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.stream = Stream(self.process.stdout.fileno(),
+                self.process.stdin.fileno(), self.timeout)
+
+    def close(self):
+        """Stop receiver and forget the stream. Does not return anything.
+        """
+        if self.process is None:
+            return
+        # past deadline or not, receiver is told to keep its progress
+        self.stream.deadline = None
+        try:
+            self.stream.write('Q')
+        except StreamError:
+            pass
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+        self.process = None
+        self.stream = None
+
+    def send_file(self, path, relpath, digest, blocks, blocksize, bucket,
+            stats, resumable=False, full=False):
+        """Send changed blocks of a file and commit it, sending only data
+        extents and recreating holes remotely. Resumable transfers are
+        staged by receiver, which reports already staged blocks as known.
+        Updates stats with number of sent and remotely allocated bytes.
+        Returns None on success or error message from receiver.
+        """
+        mystat = os.stat(path)
+        header = '\0'.join([relpath, str(blocksize),
+            oct(mystat.st_mode & 07777), str(int(mystat.st_mtime)), digest,
+            str(int(resumable))])
+        self.stream.write('O', mystat.st_size, header)
+
+        # receiver tells which blocks it believes it has
+        op, number, payload = self.stream.read()
+        if op == 'E':
+            return payload
+        remote = []
+        if not full and number == blocksize:
+            remote = [payload[i:i + DIGEST_LEN]
+                    for i in xrange(0, len(payload), DIGEST_LEN)]
+
+        myfile = open(path, 'rb')
+        try:
+            extents = data_extents(myfile.fileno(), mystat.st_size)
+            for i, blockdigest in enumerate(blocks):
+                if i < len(remote) and remote[i] == blockdigest:
+                    continue
+                for isdata, offset, length in split_extents(extents,
+                        i * blocksize, min(blocksize,
+                            mystat.st_size - i * blocksize)):
+                    if not isdata:
+                        self.stream.write('H', offset, str(length))
+                        continue
+                    myfile.seek(offset)
+                    data = myfile.read(length)
+                    bucket.consume(len(data))
+                    self.stream.write('D', offset, data)
+                    stats['sent'] += len(data)
+        finally:
+            myfile.close()
+
+        self.stream.write('C', mystat.st_size, digest + ''.join(blocks))
+        op, _, payload = self.stream.read()
+        if op != 'K':
+            return payload
+        stats['remote_allocated'] = int(payload)
+        return None
+
+
+class Incoming(object):
+    """File being received: open target (file itself or its staging copy
+    for resumable transfers) and what is known about it.
+    """
+    def __init__(self, myfile, path, relpath, size, blocksize, mode, mtime,
+            digest, staging):
+        self.myfile = myfile
+        self.path = path
+        self.relpath = relpath
+        self.size = size
+        self.blocksize = blocksize
+        self.mode = mode
+        self.mtime = mtime
+        self.digest = digest
+        self.staging = staging
+        # indexes of blocks completely written into staging file
+        self.staged = set()
+        self.unsaved = 0
+
+
+class Receiver(object):
+    """Receiving side, applies blocks in place (or in staging area for
+    resumable transfers) and verifies whole file digest on commit. Block
+    digests of every received file are kept in state directory so next
+    transfer can skip unchanged blocks.
+    """
+    def __init__(self, root, statedir, stream):
+        self.root = root
+        self.statedir = statedir
+        self.stream = stream
+        self.incoming = None
+
+    def state_path(self, relpath):
+        """Returns path of state file for a given relative path.
+        """
+        return os.path.join(self.statedir, hashlib.sha1(relpath).hexdigest())
+
+    def staging_path(self, relpath):
+        """Returns path of staging file for a given relative path.
+        """
+        return os.path.join(self.statedir, 'staging',
+                hashlib.sha1(relpath).hexdigest())
+
+    def known_blocks(self, path, relpath):
+        """Get block digests stored on last commit, provided the file has
+        not changed since. Returns (block size, digests) or (0, []).
+        """
+        try:
+            statefile = open(self.state_path(relpath), 'rb')
+            try:
+                size, mtime, blocksize, blocks = cPickle.load(statefile)
+            finally:
+                statefile.close()
+            mystat = os.stat(path)
+        except (IOError, OSError, EOFError, ValueError, cPickle.PickleError):
+            return 0, []
+        if mystat.st_size != size or int(mystat.st_mtime) != mtime:
+            return 0, []
+        return blocksize, blocks
+
+    def save_blocks(self, path, relpath, blocksize, blocks):
+        """Store block digests of a committed file. Does not return
+        anything.
+        """
+        mystat = os.stat(path)
+        statepath = self.state_path(relpath)
+        statefile = open(statepath + '.tmp', 'wb')
+        try:
+            cPickle.dump((mystat.st_size, int(mystat.st_mtime), blocksize,
+                blocks), statefile, -1)
+        finally:
+            statefile.close()
+        os.rename(statepath + '.tmp', statepath)
+
+    def load_progress(self, relpath, digest, blocksize):
+        """Get blocks staged by an interrupted transfer of the same version
+        of a file. Returns set of block indexes.
+        """
+        try:
+            progressfile = open(self.state_path(relpath) + '.progress', 'rb')
+            try:
+                mydigest, myblocksize, staged = cPickle.load(progressfile)
+            finally:
+                progressfile.close()
+        except (IOError, EOFError, ValueError, cPickle.PickleError):
+            return set()
+        if (mydigest, myblocksize) != (digest, blocksize) or \
+                not os.path.exists(self.staging_path(relpath)):
+            return set()
+        return staged
+
+    def save_progress(self):
+        """Persist staged blocks of file being received, after making sure
+        they are on disk. Does not return anything.
+        """
+        incoming = self.incoming
+        incoming.myfile.flush()
+        os.fsync(incoming.myfile.fileno())
+        progresspath = self.state_path(incoming.relpath) + '.progress'
+        progressfile = open(progresspath + '.tmp', 'wb')
+        try:
+            cPickle.dump((incoming.digest, incoming.blocksize,
+                incoming.staged), progressfile, -1)
+        finally:
+            progressfile.close()
+        os.rename(progresspath + '.tmp', progresspath)
+        incoming.unsaved = 0
+
+    def forget_progress(self, relpath):
+        """Remove staging file and progress of a given relative path. Does
+        not return anything.
+        """
+        for path in (self.staging_path(relpath),
+                self.state_path(relpath) + '.progress'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def open_file(self, size, payload):
+        """Start receiving a file. Does not return anything.
+        """
+        relpath, blocksize, mode, mtime, digest, resumable = \
+                payload.split('\0')
+        blocksize = int(blocksize)
+        path = os.path.join(self.root, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        knownsize, blocks = self.known_blocks(path, relpath)
+        if knownsize != blocksize:
+            blocks = []
+
+        if resumable == '1':
+            target = self.staging_path(relpath)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            staged = self.load_progress(relpath, digest, blocksize)
+            if not staged:
+                open(target, 'wb').close()
+        else:
+            target = path
+            staged = set()
+            if not os.path.exists(target):
+                open(target, 'wb').close()
+        self.incoming = Incoming(open(target, 'r+b'), path, relpath, size,
+                blocksize, int(mode, 8), int(mtime), digest,
+                resumable == '1')
+
+        # blocks staged by interrupted transfer are verified by rereading
+        # them, so a torn write is simply sent again
+        if staged:
+            blocks = list(blocks)
+            myfile = self.incoming.myfile
+            for i in sorted(staged):
+                while len(blocks) <= i:
+                    blocks.append('0' * DIGEST_LEN)
+                myfile.seek(i * blocksize)
+                blocks[i] = hashlib.sha1(myfile.read(blocksize)).hexdigest()
+            self.incoming.staged = staged
+        if blocks:
+            knownsize = blocksize
+        self.stream.write('B', knownsize, ''.join(blocks))
+
+    def received(self, offset, length):
+        """Account for data or hole written at offset, marking its block
+        staged when this was the last piece of it. Does not return
+        anything.
+        """
+        incoming = self.incoming
+        end = offset + length
+        if end % incoming.blocksize == 0 or end >= incoming.size:
+            incoming.staged.add((end - 1) // incoming.blocksize)
+            incoming.unsaved += 1
+            if incoming.staging and incoming.unsaved >= PROGRESS_BLOCKS:
+                self.save_progress()
+
+    def fill_unchanged(self, incoming):
+        """Copy blocks which were not sent from current version of the file
+        into staging file, keeping holes. Does not return anything.
+        """
+        try:
+            oldfile = open(incoming.path, 'rb')
+        except IOError:
+            oldfile = None
+        try:
+            extents = []
+            if oldfile:
+                extents = data_extents(oldfile.fileno(),
+                        os.fstat(oldfile.fileno()).st_size)
+            for i in xrange(0, (incoming.size + incoming.blocksize - 1) //
+                    incoming.blocksize):
+                if i in incoming.staged:
+                    continue
+                offset = i * incoming.blocksize
+                for isdata, offset, length in split_extents(extents, offset,
+                        min(incoming.blocksize, incoming.size - offset)):
+                    if isdata:
+                        oldfile.seek(offset)
+                        incoming.myfile.seek(offset)
+                        incoming.myfile.write(oldfile.read(length))
+                    else:
+                        self.punch(incoming, offset, length)
+        finally:
+            if oldfile:
+                oldfile.close()
+
+    def commit_file(self, size, payload):
+        """Finish receiving a file and verify it. For resumable transfers
+        staging file is renamed into place. Does not return anything.
+        """
+        incoming = self.incoming
+        self.incoming = None
+        try:
+            if incoming.staging:
+                self.fill_unchanged(incoming)
+            incoming.myfile.truncate(size)
+            incoming.myfile.flush()
+            os.fsync(incoming.myfile.fileno())
+        finally:
+            incoming.myfile.close()
+        target = incoming.myfile.name
+
+        # payload is whole file digest followed by block digests
+        received, blocks = sha1sum(target, incoming.blocksize)
+        if received != payload[:DIGEST_LEN]:
+            try:
+                os.remove(self.state_path(incoming.relpath))
+            except OSError:
+                pass
+            if incoming.staging:
+                self.forget_progress(incoming.relpath)
+            self.stream.write('E', 0, 'digest mismatch for %s' %
+                    incoming.relpath)
+            return
+
+        os.chmod(target, incoming.mode)
+        os.utime(target, (incoming.mtime, incoming.mtime))
+        if incoming.staging:
+            os.rename(target, incoming.path)
+            self.forget_progress(incoming.relpath)
+        self.save_blocks(incoming.path, incoming.relpath, incoming.blocksize,
+                blocks)
+        self.stream.write('K', 0, str(os.stat(incoming.path).st_blocks *
+            512))
+
+    def serve(self):
+        """Serve sender until it quits. Does not return anything.
+        """
+        while True:
+            try:
+                op, number, payload = self.stream.read()
+            except StreamError:
+                break
+            try:
+                if op == 'O':
+                    self.open_file(number, payload)
+                elif op == 'D':
+                    self.incoming.myfile.seek(number)
+                    self.incoming.myfile.write(payload)
+                    self.received(number, len(payload))
+                elif op == 'H':
+                    self.punch(self.incoming, number, int(payload))
+                    self.received(number, int(payload))
+                elif op == 'C':
+                    self.commit_file(number, payload)
+                elif op == 'Q':
+                    break
+            except (IOError, OSError), err:
+                # drain the rest of this file and report error on commit
+                if op in ('D', 'H'):
+                    self.drain(err)
+                else:
+                    self.stream.write('E', 0, str(err))
+        # keep what has been staged for the next attempt
+        if self.incoming and self.incoming.staging:
+            self.save_progress()
+
+    def punch(self, incoming, offset, length):
+        """Make a hole in file being received. Anything past current end
+        of file is left to ftruncate(2) on commit. Does not return
+        anything.
+        """
+        myfile = incoming.myfile
+        myfile.flush()
+        size = os.fstat(myfile.fileno()).st_size
+        length = min(length, size - offset)
+        if length > 0:
+            punch_hole(myfile, offset, length)
+
+    def drain(self, err):
+        """Skip remaining data of a failed file and answer its commit with
+        an error. Does not return anything.
+        """
+        if self.incoming:
+            self.incoming.myfile.close()
+            self.incoming = None
+        while True:
+            op, _, _ = self.stream.read()
+            if op == 'C':
+                self.stream.write('E', 0, str(err))
+                return
+
+
+def transfer_file(command, path, relpath, blocksdir, blocksize, bwlimit,
+        timeout, resume_min, ratefile=None, deadline=None):
+    """Transfer a single file with native sender, reusing stream to
+    receiver between calls; files of at least resume_min bytes are staged
+    on receiver and resumed after interruption, and bandwidth follows rate
+    file if given. Stream is given up once deadline (absolute time) has
+    passed. Runs in syncer workers.
+    Returns return code, stdout and stderr just like run_with_timeout().
+    """
+    sender = Senders.get(command)
+    if sender is None:
+        sender = Senders[command] = Sender(command, timeout)
+
+    # summer block digests are usable only if file has not changed since
+    try:
+        mystat = os.stat(path)
+    except OSError, err:
+        return FILE_ERROR, '', str(err)
+    record = read_blocks(blocksdir, path)
+    if record and record[:3] == (mystat.st_size, int(mystat.st_mtime),
+            blocksize):
+        digest, blocks = record[3:]
+    else:
+        digest, blocks = sha1sum(path, blocksize)
+
+    stats = {'sent': 0, 'remote_allocated': 0}
+    resumable = mystat.st_size >= resume_min
+    try:
+        sender.connect()
+        sender.stream.deadline = deadline
+        bucket = TokenBucket(bwlimit, ratefile, deadline)
+        error = sender.send_file(path, relpath, digest, blocks, blocksize,
+                bucket, stats, resumable)
+        # local file changed under our feet or remote got corrupted,
+        # resend all blocks once
+        if error:
+            digest, blocks = sha1sum(path, blocksize)
+            error = sender.send_file(path, relpath, digest, blocks,
+                    blocksize, bucket, stats, resumable, full=True)
+    except DeadlineError, err:
+        sender.close()
+        return DEADLINE_ERROR, '', str(err)
+    except StreamError, err:
+        sender.close()
+        return STREAM_ERROR, '', str(err)
+    except (IOError, OSError), err:
+        sender.close()
+        return FILE_ERROR, '', str(err)
+    if error:
+        return FILE_ERROR, '', error
+    return 0, 'logical %d allocated %d sent %d remote allocated %d' % \
+            (mystat.st_size, mystat.st_blocks * 512, stats['sent'],
+                stats['remote_allocated']), ''
+
+def manifest(root, cachepath, output):
+    """Write manifest of all regular files below root, one per line as
+    digest, size, mtime, octal permissions and relative path. Digests are
+    cached in cachepath and recomputed only for files whose size or mtime
+    changed. Does not return anything.
+    """
+    try:
+        cachefile = open(cachepath, 'rb')
+        try:
+            cache = cPickle.load(cachefile)
+        finally:
+            cachefile.close()
+    except (IOError, EOFError, ValueError, cPickle.PickleError):
+        cache = {}
+
+    files = {}
+    for dirpath, dirs, names in os.walk(root):
+        # skip rsync(1) partial transfers
+        if '.rsync-partial' in dirs:
+            dirs.remove('.rsync-partial')
+        for name in names:
+            path = os.path.join(dirpath, name)
+            relpath = path[len(root):].lstrip('/')
+            try:
+                mystat = os.lstat(path)
+                if not stat.S_ISREG(mystat.st_mode):
+                    continue
+                size, mtime = mystat.st_size, int(mystat.st_mtime)
+                cached = cache.get(relpath)
+                if cached and cached[:2] == (size, mtime):
+                    digest = cached[2]
+                else:
+                    digest = sha1sum(path)
+            except (IOError, OSError):
+                continue
+            files[relpath] = (size, mtime, digest)
+            output.write('%s %d %d %s %s\n' % (digest, size, mtime,
+                oct(stat.S_IMODE(mystat.st_mode)), relpath))
+
+    cachefile = open(cachepath + '.tmp', 'wb')
+    try:
+        cPickle.dump(files, cachefile, -1)
+    finally:
+        cachefile.close()
+    os.rename(cachepath + '.tmp', cachepath)
+
+def main(argv):
+    if len(argv) == 4 and argv[1] == '--manifest':
+        manifest(argv[2], argv[3], sys.stdout)
+        return 0
+    if len(argv) != 3:
+        print >> sys.stderr, 'Usage: %s ROOT STATEDIR' % argv[0]
+        print >> sys.stderr, '       %s --manifest ROOT CACHEFILE' % argv[0]
+        return 2
+    if not os.path.isdir(argv[2]):
+        os.makedirs(argv[2])
+    stream = Stream(sys.stdin.fileno(), sys.stdout.fileno())
+    Receiver(argv[1], argv[2], stream).serve()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))